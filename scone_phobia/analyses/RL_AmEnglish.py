@@ -31,39 +31,31 @@ This assumes:
 
 import scone_phobia.metadata.corpora as corpora
 import scone_phobia.utils.mp_scores as mp_scores
-import numpy as np
+import scone_phobia.analyses.contrast_sets as contrast_sets
 import pandas
 
 
-def RL_AmEnglish(df):
+RL = mp_scores.mp_contrast_name('R', 'L')
+WY = mp_scores.mp_contrast_name('W', 'Y')
+# rl, wy (each on their own) and all consonant contrasts but R/L,
+# labeled in the 'contrast' column
+RL_AMENGLISH_SPEC = {'language': 'American English',
+                     'sets': [(RL, [RL]), (WY, [WY]),
+                              ('all_C',
+                               lambda lang: corpora.contrasts(lang, 'C').drop(
+                                                                        RL))],
+                     'label_col': 'contrast'}
+
+
+@mp_scores.replicate_vectorized
+@contrast_sets.contrast_set_analysis(RL_AMENGLISH_SPEC)
+def RL_AmEnglish(df, averages):
     """
     Select only r/l and w/y, plus add average on consonant contrasts rows
-    TODO? do the two parts using separate functions shared with other analyses
     """
-    assert 'test language' in df.columns, df.columns
-    assert 'error' in df.columns, df.columns
-    assert 'contrast' in df.columns, df.columns
-    # rl, wy
-    target_contrasts = [mp_scores.mp_contrast_name('R', 'L'), 
-                        mp_scores.mp_contrast_name('W', 'Y')]
-    ind_AE = df['test language'] == 'American English'
-    ind_con = [e in target_contrasts for e in df['contrast']]
-   
-    df_res = df[ind_AE & ind_con].copy()  # make a copy to avoid side-effects
-    # C avg
-    # columns on which to average
-    cols = list(df.columns)
-    del cols[cols.index('contrast')]
-    del cols[cols.index('error')]
-    df_AE = df[ind_AE]
-    AE_C = corpora.consonants('American English')
-    RL = mp_scores.mp_contrast_name('R', 'L')
-    # keep all consonant contrasts but R/L
-    ind_C = [np.all([seg in AE_C for seg in con.split("-")]) and con != RL
-                for con in df_AE['contrast']]
-    df_C = df_AE[ind_C].groupby(cols, as_index=False).mean()
-    df_C['contrast'] = "all_C"    
-    
-    df_res = pandas.concat([df_res, df_C])    
+    is_C = (averages['contrast'] == 'all_C').values
+    # r/l and w/y lines in the same order as in df, followed by C averages
+    df_res = pandas.concat([averages[~is_C].sort_index(), averages[is_C]])
+    df_res = df_res[list(df.columns)]
     df_res = df_res.reset_index(drop=True)
     return df_res
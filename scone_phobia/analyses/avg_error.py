@@ -18,38 +18,21 @@ This assumes:
 
 
 import scone_phobia.metadata.corpora as corpora
-import numpy as np
-import pandas
-
-
-def avg_error(df):
-    assert 'test language' in df.columns, df.columns
-    assert 'error' in df.columns, df.columns
-    assert 'contrast' in df.columns, df.columns
-    avg_dfs = []
-    # columns on which to average
-    cols = list(df.columns)
-    del cols[cols.index('contrast')]
-    del cols[cols.index('error')]
-    # iterate over test languages
-    test_langs = np.unique(df['test language'])  
-    for lang in test_langs:
-        # get relevant sub-dataframe
-        ind_lang = df['test language'] == lang
-        df_lang = df[ind_lang]
-        # get segment types for lang
-        lang_C = corpora.consonants(lang)
-        lang_V = corpora.vowels(lang)
-        all_seg = lang_C +lang_V
-        # for each segment type, get average errors
-        for segs, seg_type in [(lang_C, 'C'), (lang_V, 'V'), (all_seg, 'all')]:
-            # get indices of contrasts involving two segments of desired type
-            ind_segs = [np.all([seg in segs for seg in con.split("-")])
-                                                for con in df_lang['contrast']]
-            # average over those contrasts based on groups defined by cols
-            avg = df_lang[ind_segs].groupby(cols, as_index=False).mean()
-            avg['contrast type'] = seg_type
-            avg_dfs.append(avg)
-    res_df = pandas.concat(avg_dfs)    
-    res_df = res_df.reset_index(drop=True)
-    return res_df
+import scone_phobia.utils.mp_scores as mp_scores
+import scone_phobia.analyses.contrast_sets as contrast_sets
+
+
+# contrasts between two consonants, two vowels or any two segments
+# for each test language
+AVG_ERROR_SPEC = {'sets': [('C', lambda lang: corpora.contrasts(lang, 'C')),
+                           ('V', lambda lang: corpora.contrasts(lang, 'V')),
+                           ('all', corpora.contrasts)],
+                  'label_col': 'contrast type'}
+
+
+@mp_scores.replicate_vectorized
+@contrast_sets.contrast_set_analysis(AVG_ERROR_SPEC)
+def avg_error(df, averages):
+    # averages are already in the expected format
+    # (see contrast_sets.set_averages)
+    return averages.reset_index(drop=True)
@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+"""
+Engine for 'contrast-set' analyses, i.e. analyses averaging minimal-pair
+errors over sets of contrasts (e.g. all consonant contrasts, all vowel length
+contrasts, ...) for each group of lines sharing the same values in all
+columns but 'contrast' and 'error' (see avg_error.py, RL_AmEnglish.py and
+len_vs_quality_JapV.py).
+
+Contrast-set analyses are specified declaratively as dicts with entries:
+  - 'sets': list of (label, contrasts) pairs, where contrasts is a list of
+        contrast names or a function taking a language and returning such a
+        list (e.g. corpora.contrasts)
+  - 'language' (optional): only use lines whose 'test language' is
+        language. If None (default), sets are evaluated separately for each
+        language in the 'test language' column.
+  - 'label_col' (optional): name of the column where set labels are stored
+        in the results (default: 'contrast type')
+
+All sets of all specs are compiled into a membership matrix between sets and
+contrasts, and the averages for all sets and all groups of lines are then
+obtained in a single weighted bincount. Bootstrap replicates stacked together
+are just additional groups of lines, so that contrast-set analyses are
+replicate_vectorized.
+
+To evaluate several contrast-set analyses (defined with the
+contrast_set_analysis decorator) in one pass, use run_analyses.
+"""
+
+import functools
+import numpy as np
+import pandas
+import scone_phobia.utils.mp_scores as mp_scores
+
+
+def spec_sets(spec, languages):
+    # (language, label, contrasts) for each set of spec, in the order in
+    # which they appear in the results
+    language = spec.get('language', None)
+    if language is None:
+        spec_languages = languages
+    else:
+        spec_languages = [language]
+    sets = []
+    for lang in spec_languages:
+        for label, contrasts in spec['sets']:
+            if callable(contrasts):
+                contrasts = contrasts(lang)
+            sets.append((lang, label, contrasts))
+    return sets
+
+
+def set_averages(df, specs):
+    """
+    Average errors over each set of contrasts of each spec in specs, for
+    each group of lines of df sharing the same values in all columns but
+    'contrast' and 'error'.
+
+    Returns a DataFrame for each spec, with the grouping columns, an 'error'
+    column and a column containing the labels of the sets. Lines are ordered
+    by language, then by set (in the order of the spec), then by group (as in
+    df.groupby). The index gives the position in df of the first line
+    averaged in each group (to restore the order of lines in df if needed).
+    """
+    assert 'test language' in df.columns, df.columns
+    assert 'error' in df.columns, df.columns
+    assert 'contrast' in df.columns, df.columns
+    cols = [col for col in df.columns if not(col in ['contrast', 'error'])]
+    # (grouping on codes, ngroup is not sorted for categoricals in some
+    # pandas versions)
+    group_ids = df.groupby(mp_scores.group_keys(df, cols),
+                           sort=True).ngroup().values
+    n_groups = group_ids.max()+1 if len(group_ids) else 0
+    contrast_ids, contrasts = pandas.factorize(df['contrast'])
+    language_ids, languages = pandas.factorize(df['test language'],
+                                               sort=True)
+    # membership matrix between sets and contrasts of df (with an extra
+    # column, never set, for missing contrasts), and language of each set
+    sets = [spec_sets(spec, list(languages)) for spec in specs]
+    all_sets = [e for spec_sets_ in sets for e in spec_sets_]
+    membership = np.zeros((len(all_sets), len(contrasts)+1), dtype=bool)
+    set_languages = np.zeros(len(all_sets), dtype=np.int64)
+    for i, (lang, label, set_contrasts) in enumerate(all_sets):
+        membership[i, :-1] = contrasts.isin(set_contrasts)
+        set_languages[i] = languages.get_loc(lang) if lang in languages \
+                                                    else -1
+    # lines (of each set) in which to average errors
+    valid = (group_ids >= 0) & (language_ids >= 0)
+    set_ids, rows = np.nonzero(membership[:, contrast_ids] &
+                               (language_ids[None, :] ==
+                                set_languages[:, None]) &
+                               valid[None, :])
+    keys = set_ids*n_groups + group_ids[rows]
+    errors = df['error'].values.astype(np.float64)[rows]
+    # missing errors are skipped, as in groupby().mean() (sets where all
+    # errors are missing get a NaN average)
+    observed = ~np.isnan(errors)
+    sums = np.bincount(keys[observed], weights=errors[observed],
+                       minlength=len(all_sets)*n_groups)
+    counts = np.bincount(keys[observed], minlength=len(all_sets)*n_groups)
+    # rows are sorted within each set, so first occurrences of keys are
+    # the first lines of each (set, group)
+    used_keys, first = np.unique(keys, return_index=True)
+    first_rows = rows[first]
+    res = []
+    offset = 0
+    for spec, spec_sets_ in zip(specs, sets):
+        n = len(spec_sets_)
+        in_spec = (used_keys >= offset*n_groups) & \
+                  (used_keys < (offset+n)*n_groups)
+        spec_keys = used_keys[in_spec]
+        spec_first_rows = first_rows[in_spec]
+        res_df = df[cols].iloc[spec_first_rows].copy()
+        with np.errstate(invalid='ignore'):
+            res_df['error'] = sums[spec_keys]/counts[spec_keys]
+        labels = np.array([label for _, label, _ in spec_sets_], dtype=object)
+        res_df[spec.get('label_col', 'contrast type')] = \
+                        labels[spec_keys // n_groups - offset]
+        res.append(res_df)
+        offset = offset + n
+    return res
+
+
+def contrast_set_analysis(spec):
+    """
+    Decorator turning a function format_results(df, averages), where
+    averages are the results of set_averages(df, [spec]), into an analysis
+    taking df as its only argument. run_analyses evaluates together the
+    specs of several such analyses.
+    """
+    def decorator(format_results):
+        def analysis(df):
+            return format_results(df, set_averages(df, [spec])[0])
+        functools.update_wrapper(analysis, format_results)
+        analysis.contrast_set_spec = spec
+        analysis.format_results = format_results
+        return analysis
+    return decorator
+
+
+def run_analyses(df, analyses):
+    """
+    Apply each analysis of the dict analyses to df, returning a dict with
+    the same keys. The set averages needed by all contrast-set analyses are
+    computed together in a single pass, other analyses are applied
+    independently.
+    """
+    names = [name for name in analyses
+             if hasattr(analyses[name], 'contrast_set_spec')]
+    specs = [analyses[name].contrast_set_spec for name in names]
+    averages = dict(zip(names, set_averages(df, specs))) if names else {}
+    res = {}
+    for name, analysis in analyses.items():
+        if name in averages:
+            res[name] = analysis.format_results(df, averages[name])
+        else:
+            res[name] = analysis(df)
+    return res
@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+"""
+Rank contrasts as a function of how much they contribute to the
+dissimilarity between the patterns of discrimination errors of two models on
+a common test set (see the end of error_sim.py for the derivation).
+
+The main function is error_contrib.
+
+For each pair of models (A, B) compared by error_sim and each contrast
+available for both models, the following columns are returned:
+  - 'error A', 'error B': the errors of the two models on the contrast,
+  - 'score': (rA-rB)^2, where rA (resp. rB) is the ratio of the error of
+    model A (resp. B) on the contrast to its average error on the N other
+    contrasts. Up to a 1/(2N^2) factor, this bounds the (first-order) increase
+    of the angle between the two error patterns when the contrast is added.
+  - 'approx delta': change in angular distance (1 - error_sim similarity)
+    when the contrast is added to the N other contrasts, using the
+    first-order expansion of the cosine similarity:
+        cos(a1) ~ cos(a0) * [1 - xA^2/2 - xB^2/2] + xA*xB
+    where xA = errA/||a||, xB = errB/||b|| and a, b are the error patterns on
+    the N other contrasts.
+  - 'delta': exact change in angular distance when the contrast is added
+    (i.e. angular distance on all contrasts minus angular distance when
+    leaving this contrast out). Positive values indicate contrasts that
+    make the models more dissimilar.
+
+Only unordered pairs of distinct models are considered: model A is the
+first one when sorting models on their metadata.
+
+This assumes the same things as error_sim.
+"""
+
+import numpy as np
+import pandas
+import scone_phobia.utils.mp_scores as mp_scores
+import scone_phobia.analyses.error_sim as error_sim
+
+
+def angular_distance_from_cos(s):
+    return 1-error_sim.angular_sim_from_cos(s)
+
+
+# maximum number of (replicate, pair, contrast) entries processed at once
+CHUNK_SIZE = 2**20
+
+
+def pair_contributions(x_a, x_b, common):
+    """
+    Contributions of each contrast to the dissimilarity between pairs of
+    models, from (replicate, pair, contrast) arrays of errors of models A
+    and B (0 outside common contrasts) and of contrasts common to both.
+    Returns arrays of the same shape: score, approx delta and delta,
+    NaN for contrasts not available for both models.
+    """
+    n_common = common.sum(axis=2, keepdims=True)
+    sum_a = x_a.sum(axis=2, keepdims=True)
+    sum_b = x_b.sum(axis=2, keepdims=True)
+    sq_a = (x_a**2).sum(axis=2, keepdims=True)
+    sq_b = (x_b**2).sum(axis=2, keepdims=True)
+    dot = (x_a*x_b).sum(axis=2, keepdims=True)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        # leaving each contrast out in turn
+        n = n_common - 1
+        r_a = x_a / ((sum_a - x_a) / n)
+        r_b = x_b / ((sum_b - x_b) / n)
+        score = (r_a - r_b)**2
+        sq_a_out, sq_b_out = sq_a - x_a**2, sq_b - x_b**2
+        cos_out = (dot - x_a*x_b) / np.sqrt(sq_a_out*sq_b_out)
+        cos_all = dot / np.sqrt(sq_a*sq_b)
+        dist_out = angular_distance_from_cos(cos_out)
+        delta = angular_distance_from_cos(cos_all) - dist_out
+        rel_a, rel_b = x_a / np.sqrt(sq_a_out), x_b / np.sqrt(sq_b_out)
+        cos_approx = cos_out*(1 - rel_a**2/2 - rel_b**2/2) + rel_a*rel_b
+        approx_delta = angular_distance_from_cos(cos_approx) - dist_out
+    missing = ~common
+    for res in [score, approx_delta, delta]:
+        res[missing] = np.nan
+    return score, approx_delta, delta
+
+
+@mp_scores.replicate_vectorized
+@mp_scores.resampled_columns('delta', 'approx delta', 'score',
+                             'error A', 'error B')
+def error_contrib(df):
+    """
+    Main function.
+    """
+    assert 'test set' in df.columns, df.columns
+    assert 'error' in df.columns, df.columns
+    assert 'contrast' in df.columns, df.columns
+    pair_cols = error_sim.pair_columns(df)
+    model_cols = [col for col in df.columns
+                  if not(col in pair_cols + ['contrast', 'error'])]
+    rows_a, rows_b, contrasts = [], [], []
+    errors_a, errors_b, scores, approx_deltas, deltas = [], [], [], [], []
+    for rows, errors, mask, set_contrasts in error_sim.error_tensors(df):
+        n_boot, n_models, n_contrasts = errors.shape
+        set_contrasts = np.asarray(set_contrasts, dtype=object)
+        # all replicates at once, for bounded chunks of (A, B) pairs
+        pairs_a, pairs_b = np.triu_indices(n_models, k=1)
+        chunksize = max(1, CHUNK_SIZE // max(1, n_boot*n_contrasts))
+        set_res = []
+        for start in range(0, len(pairs_a), chunksize):
+            i = pairs_a[start:start+chunksize]
+            j = pairs_b[start:start+chunksize]
+            common = mask[:, i, :] & mask[:, j, :]
+            x_a = np.where(common, errors[:, i, :], 0)
+            x_b = np.where(common, errors[:, j, :], 0)
+            score, approx_delta, delta = pair_contributions(x_a, x_b, common)
+            b, p, k = np.nonzero(common)
+            set_res.append((b, start+p, k, rows[b, i[p]], rows[b, j[p]],
+                            x_a[b, p, k], x_b[b, p, k], score[b, p, k],
+                            approx_delta[b, p, k], delta[b, p, k]))
+        if not(set_res):
+            continue
+        set_res = [np.concatenate(e) for e in zip(*set_res)]
+        # lines ordered by replicate, then pair, then contrast
+        b, p, k = set_res[:3]
+        order = np.lexsort((k, p, b))
+        set_res = [e[order] for e in set_res]
+        rows_a.append(set_res[3])
+        rows_b.append(set_res[4])
+        contrasts.append(set_contrasts[set_res[2]])
+        errors_a.append(set_res[5])
+        errors_b.append(set_res[6])
+        scores.append(set_res[7])
+        approx_deltas.append(set_res[8])
+        deltas.append(set_res[9])
+    concat = lambda arrays, dtype=np.float64: np.concatenate(arrays) \
+                                if arrays else np.zeros(0, dtype=dtype)
+    rows_a, rows_b = concat(rows_a, np.int64), concat(rows_b, np.int64)
+    res_df = pandas.DataFrame(index=np.arange(len(rows_a)))
+    # same columns as error_sim, plus one line per contrast
+    for col in df.columns:
+        if col in pair_cols:
+            res_df[col] = df[col].iloc[rows_a].values
+        elif not(col in ['contrast', 'error']):
+            res_df[col + ' A'] = df[col].iloc[rows_a].values
+    for col in model_cols:
+        res_df[col + ' B'] = df[col].iloc[rows_b].values
+    res_df['contrast'] = concat(contrasts, object)
+    res_df['error A'] = concat(errors_a)
+    res_df['error B'] = concat(errors_b)
+    res_df['score'] = concat(scores)
+    res_df['approx delta'] = concat(approx_deltas)
+    res_df['delta'] = concat(deltas)
+    return res_df
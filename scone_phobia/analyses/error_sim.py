@@ -30,6 +30,7 @@ This assumes:
 
 import numpy as np
 import pandas
+import scone_phobia.utils.mp_scores as mp_scores
 
 
 def cosine_sim(a, b):
@@ -53,6 +54,110 @@ def compute_err_sim(df, sim=angular_sim):
                           index=['err_sim'])
 
 
+def angular_sim_from_cos(s, eps=10**-9):
+    # same as angular_sim, from an array of cosine similarities
+    s = np.where((s > 1) & (s-1 < eps), 1, s)
+    s = np.where((s < -1) & (-1-s < eps), -1, s)
+    with np.errstate(invalid='ignore'):
+        return 1-2*np.arccos(s)/np.pi
+
+
+# Instead of merging the DataFrame with itself and computing similarities
+# pair by pair, errors are put in a (replicate, model, contrast) array for
+# each test set, where 'models' are the groups of lines sharing the same
+# values in all columns but 'contrast', 'error', the test set columns and the
+# columns identifying bootstrap replicates (if any), and replicates are the
+# groups of lines sharing the same values in the latter. Dot products and
+# norms for all pairs of models are then obtained with matrix products. As in
+# the pairwise version, each pair of models is compared on the contrasts for
+# which both have an error.
+
+def pair_columns(df):
+    # columns that must be equal for two groups of lines to be compared
+    merge_cols = ['test set', 'test language', 'test register']
+    boot_cols = mp_scores.BOOT_COLS
+    return [col for col in df.columns if col in merge_cols + boot_cols]
+
+
+def error_tensors(df):
+    """
+    For each test set (as defined by the pair columns other than those
+    identifying bootstrap replicates), yields:
+        rows : indices (in df) of a line for each (replicate, model),
+               -1 if the model is missing in the replicate
+        errors : (replicate, model, contrast) array of errors
+        mask : boolean array of the same shape, indicating
+               available errors
+        contrasts : names of the contrasts
+    """
+    pair_cols = pair_columns(df)
+    set_cols = [col for col in pair_cols if not(col in mp_scores.BOOT_COLS)]
+    model_cols = [col for col in df.columns
+                  if not(col in pair_cols + ['contrast', 'error'])]
+    # (grouping on codes, ngroup is not sorted for categoricals in some
+    # pandas versions)
+    ids = lambda cols: df.groupby(mp_scores.group_keys(df, cols),
+                                  sort=True).ngroup().values \
+                        if cols else np.zeros(len(df), dtype=np.int64)
+    set_ids = ids(set_cols)
+    # (test set, replicate) blocks, sorted by test set first
+    block_ids = ids(set_cols + [col for col in pair_cols
+                                if not(col in set_cols)])
+    model_ids = ids(model_cols)
+    contrast_ids, contrasts = pandas.factorize(df['contrast'], sort=True)
+    errors = df['error'].values.astype(np.float64)
+    for set_id in np.unique(set_ids[set_ids >= 0]):
+        ix = np.where((set_ids == set_id) & (block_ids >= 0) &
+                      (model_ids >= 0))[0]
+        blocks, b = np.unique(block_ids[ix], return_inverse=True)
+        models, m = np.unique(model_ids[ix], return_inverse=True)
+        set_contrasts, c = np.unique(contrast_ids[ix], return_inverse=True)
+        shape = (len(blocks), len(models), len(set_contrasts))
+        flat = np.ravel_multi_index((b, m, c), shape)
+        if len(np.unique(flat)) < len(flat):
+            raise ValueError(("Several errors for a same contrast in a group"
+                              " of lines sharing the same values in all"
+                              " columns but 'contrast' and 'error'"))
+        error_tensor = np.zeros(shape)
+        mask = np.zeros(shape, dtype=bool)
+        error_tensor[b, m, c] = errors[ix]
+        mask[b, m, c] = True
+        rows = np.full(shape[:2], -1, dtype=np.int64)
+        rows[b, m] = ix
+        yield rows, error_tensor, mask, contrasts[set_contrasts]
+
+
+def pairwise_cosines(errors, mask):
+    """
+    Cosine similarities between the error patterns of all pairs of
+    models in each replicate, computed on the contrasts available for both
+    models, from (replicate, model, contrast) errors and mask arrays.
+    Also returns the number of contrasts available for both models.
+    """
+    dots = np.matmul(errors, errors.transpose(0, 2, 1))
+    if mask.all():
+        n_common = np.full(dots.shape, mask.shape[2])
+        norms = np.sqrt(np.sum(errors**2, axis=2))
+        norms_a, norms_b = norms[:, :, None], norms[:, None, :]
+    else:
+        mask = mask.astype(np.float64)
+        n_common = np.matmul(mask, mask.transpose(0, 2, 1))
+        # squared norm of model A on the contrasts available for model B
+        sq_norms_a = np.matmul(errors**2, mask.transpose(0, 2, 1))
+        norms_a = np.sqrt(sq_norms_a)
+        norms_b = np.sqrt(sq_norms_a.transpose(0, 2, 1))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        cosines = dots/(norms_a*norms_b)
+    # the similarity of a model with itself is exactly 1 (up to rounding
+    # errors that arccos would amplify to ~1e-8)
+    diag = np.arange(cosines.shape[1])
+    self_cosines = cosines[:, diag, diag]
+    cosines[:, diag, diag] = np.where(np.isnan(self_cosines), np.nan, 1)
+    return cosines, n_common
+
+
+@mp_scores.replicate_vectorized
+@mp_scores.resampled_columns('err_sim')
 def error_sim(df):
     """
     Main function.
@@ -60,30 +165,39 @@ def error_sim(df):
     assert 'test set' in df.columns, df.columns
     assert 'error' in df.columns, df.columns
     assert 'contrast' in df.columns, df.columns
-    # First merge on contrast and test set
-    merge_cols = ['contrast', 'test set']
-    if 'test language' in df.columns:
-        merge_cols.append('test language')
-    if 'test register' in df.columns:
-        merge_cols.append('test register')
-    # if there is more metadata derived from test set, could be specified here,
-    # but it's not a big deal if it isn't, there just will be some duplicated
-    # columns.    
-    df = df.merge(df, on=merge_cols, suffixes=(' A', ' B'))
-    # Second group by all columns but contrast and error_A/B and get cosine sim
-    groupby_cols = list(df.columns)
-    del groupby_cols[groupby_cols.index('contrast')]
-    del groupby_cols[groupby_cols.index('error A')]
-    del groupby_cols[groupby_cols.index('error B')]
-    res_df = df.groupby(groupby_cols).apply(compute_err_sim)
-    # multi-indices -> cols
-    res_df.reset_index(level=res_df.index.names, inplace=True)
+    pair_cols = pair_columns(df)
+    model_cols = [col for col in df.columns
+                  if not(col in pair_cols + ['contrast', 'error'])]
+    rows_a, rows_b, sims = [], [], []
+    for rows, errors, mask, _ in error_tensors(df):
+        cosines, n_common = pairwise_cosines(errors, mask)
+        # pairs of models sharing at least one contrast
+        b, i, j = np.where(n_common > 0)
+        rows_a.append(rows[b, i])
+        rows_b.append(rows[b, j])
+        sims.append(angular_sim_from_cos(cosines[b, i, j]))
+    rows_a = np.concatenate(rows_a) if rows_a else np.zeros(0, dtype=np.int64)
+    rows_b = np.concatenate(rows_b) if rows_b else np.zeros(0, dtype=np.int64)
+    # same columns as when merging df with itself on contrast and pair
+    # columns, then grouping on all columns but contrast and errors
+    res_df = pandas.DataFrame(index=np.arange(len(rows_a)))
+    for col in df.columns:
+        if col in pair_cols:
+            res_df[col] = df[col].iloc[rows_a].values
+        elif not(col in ['contrast', 'error']):
+            res_df[col + ' A'] = df[col].iloc[rows_a].values
+    for col in model_cols:
+        res_df[col + ' B'] = df[col].iloc[rows_b].values
+    groupby_cols = list(res_df.columns)
+    res_df['err_sim'] = np.concatenate(sims) if sims else np.zeros(0)
+    res_df = res_df.sort_values(groupby_cols, kind='mergesort')
+    res_df = res_df.reset_index(drop=True)
     return res_df
 
 
 """
 
-Possible extension to consider:
+Possible extension to consider (implemented in error_contrib.py):
     
     For each possible pair of models, ranking
     contrasts as a function of how much they contribute to the dissimilarity
@@ -31,6 +31,22 @@ This assumes:
 # the contrast as specified in the 'contrast' column
 # of the mp_error dataframe.
 import scone_phobia.utils.mp_scores as mp_scores
+import scone_phobia.analyses.contrast_sets as contrast_sets
+import numpy as np
+
+
+# would be cleaner to get that from scone_phobia.metadata.corpora maybe
+Vquals = ['a', 'e', 'i', 'o', 'u']
+duration = [mp_scores.mp_contrast_name(V, V+'+H') for V in Vquals]
+quality = [mp_scores.mp_contrast_name(V1, V2)
+            for V1 in Vquals for V2 in Vquals if V1<V2] + \
+          [mp_scores.mp_contrast_name(V1+'+H', V2+'+H')
+              for V1 in Vquals for V2 in Vquals if V1<V2]
+# Japanese vowel length and vowel quality contrasts, as indicated
+# by the 'contrast type' column
+LEN_VS_QUALITY_SPEC = {'language': 'Japanese',
+                       'sets': [('length', duration), ('quality', quality)],
+                       'label_col': 'contrast type'}
 
 
 ############################
@@ -50,38 +66,40 @@ def select_mp_errors(df):
                     quality contrasts, as indicated by a new
                     'contrast type' column
     """
-    # would be cleaner to get that from scone_phobia.metadata.corpora maybe
-    Vquals = ['a', 'e', 'i', 'o', 'u']
-    duration = [mp_scores.mp_contrast_name(V, V+'+H') for V in Vquals]
-    quality = [mp_scores.mp_contrast_name(V1, V2)
-                for V1 in Vquals for V2 in Vquals if V1<V2] + \
-              [mp_scores.mp_contrast_name(V1+'+H', V2+'+H')
-                  for V1 in Vquals for V2 in Vquals if V1<V2]
     target_contrasts = duration + quality
     ind_jap = df['test language'] == 'Japanese'
-    ind_con = [e in target_contrasts for e in df['contrast']]
+    ind_con = df['contrast'].isin(target_contrasts)
     df_out = df[ind_jap & ind_con].copy()  # make a copy to avoid side-effects
     df_out = df_out.reset_index(drop=True)  # get a simple index
     # add contrast type column  
-    df_out['contrast type'] = ['length' if e in duration else 'quality'
-                                                for e in df_out['contrast']]
+    df_out['contrast type'] = np.where(df_out['contrast'].isin(duration),
+                                       'length', 'quality')
     return df_out
 
 
 def avg_over_groups(df_len):
     """
-    Aggregate minimal pair errors over all length, resp. all quality contrasts
+    Average errors of the output of select_mp_errors by contrast type
+    (len_vs_quality_JapV does the selection and the averaging in one pass)
     """
     # columns on which to average
     cols = list(df_len.columns)
     del cols[cols.index('contrast')]
     del cols[cols.index('error')]
-    df_avg = df_len.groupby(cols, as_index=False).mean()
+    df_avg = df_len[cols + ['error']].groupby(cols, as_index=False,
+                                              observed=True).mean()
     return df_avg
 
 
-def len_vs_quality_JapV(df):
-    assert 'test language' in df.columns, df.columns
-    assert 'error' in df.columns, df.columns
-    assert 'contrast' in df.columns, df.columns
-    return avg_over_groups(select_mp_errors(df))
+@mp_scores.replicate_vectorized
+@contrast_sets.contrast_set_analysis(LEN_VS_QUALITY_SPEC)
+def len_vs_quality_JapV(df, averages):
+    """
+    Aggregate minimal pair errors over all length, resp. all quality contrasts
+    """
+    cols = [col for col in df.columns if not(col in ['contrast', 'error'])]
+    df_avg = averages[cols + ['contrast type', 'error']]
+    # one line per group and contrast type, as with df.groupby
+    df_avg = df_avg.sort_values(cols + ['contrast type'], kind='mergesort')
+    df_avg = df_avg.reset_index(drop=True)
+    return df_avg
@@ -6,15 +6,18 @@ Created on Wed Jun 27 12:18:50 2018
 
 Useful info about corpora of speech recordings.
 
-Currently there are four functions:
+Currently there are six functions:
     - two which take the corpus name as input and respectively return the:
         - language
         - register
-    - two which take a language as input and return the:
+    - four which take a language as input and return the:
         - list of consonants (in ASCII code or ipa, depending on
             'ipa' optional arg)
         - list of vowels  (in ASCII code or ipa, depending on
-            'ipa' optional arg).
+            'ipa' optional arg)
+        - table of all the contrasts between two of these segments
+        - names of these contrasts (optionally only consonant or vowel
+            contrasts).
 
 This assumes that the ASCII code for all corpora sharing a same langague
 is consistent. 
@@ -24,6 +27,10 @@ To add new corpora just extend these functions appropriately.
 We might want to get the info directly from spock-formatted files at some point.
 """
 
+import numpy as np
+import pandas
+
+
 def language(corpus):
     if corpus == 'None':
         lang = 'None'
@@ -141,7 +148,7 @@ def consonants(lang, ipa=False):
              'y', 'Q+p', 'm', 'n', 'c+y', 'Q+t', 'z', 'Q+s+y', 'Q+c+y', 's',
              'Q+s', 'h', 'c', 'Q+c', 'F']
     else:
-        raise "Unsupported language {}".format(lang)
+        raise ValueError("Unsupported language {}".format(lang))
     if ipa:
         C = [ipas[lang][e] for e in C]
     return C
@@ -154,7 +161,63 @@ def vowels(lang, ipa=False):
     elif lang == 'Japanese':
         V = ['i+H', 'o+H', 'e', 'u+H', 'a', 'a+H', 'i', 'o', 'u', 'e+H']
     else:
-        raise "Unsupported corpus {}".format(lang)
+        raise ValueError("Unsupported language {}".format(lang))
     if ipa:
         V = [ipas[lang][e] for e in V]
-    return V
\ No newline at end of file
+    return V
+
+
+# contrast tables are built once per language
+_contrast_tables = {}
+
+
+def contrast_table(lang):
+    """
+    pandas.DataFrame with one line for each contrast between two segments
+    (consonants or vowels) of lang, indexed by contrast name (as in the
+    'contrast' column of mp_error dataframes) and with columns:
+        - 'phone 1', 'phone 2': the two segments, in the order in which
+            they appear in the contrast name
+        - 'phone 1 ID', 'phone 2 ID': their indices in the list of the
+            consonants followed by the vowels of lang
+        - 'ipa 1', 'ipa 2': their ipa transcriptions
+        - 'class 1', 'class 2': their classes ('C' or 'V')
+        - 'contrast class': 'C' for consonant contrasts, 'V' for vowel
+            contrasts and 'CV' for the others
+    The table is cached, do not modify it.
+    """
+    if not(lang in _contrast_tables):
+        segs = consonants(lang) + vowels(lang)
+        classes = ['C']*len(consonants(lang)) + ['V']*len(vowels(lang))
+        # same naming scheme as scone_phobia.utils.mp_scores.mp_contrast_name
+        pairs = [(i, j) if segs[i] <= segs[j] else (j, i)
+                 for i in range(len(segs)) for j in range(i+1, len(segs))]
+        table = pandas.DataFrame({
+            'phone 1': [segs[i] for i, j in pairs],
+            'phone 2': [segs[j] for i, j in pairs],
+            'phone 1 ID': [i for i, j in pairs],
+            'phone 2 ID': [j for i, j in pairs],
+            'ipa 1': [ipas[lang][segs[i]] for i, j in pairs],
+            'ipa 2': [ipas[lang][segs[j]] for i, j in pairs],
+            'class 1': [classes[i] for i, j in pairs],
+            'class 2': [classes[j] for i, j in pairs]})
+        table.index = table['phone 1'] + '-' + table['phone 2']
+        table.index.name = 'contrast'
+        table['contrast class'] = np.where(
+                        table['class 1'] == table['class 2'],
+                        table['class 1'], 'CV')
+        table = table.sort_index()
+        _contrast_tables[lang] = table
+    return _contrast_tables[lang]
+
+
+def contrasts(lang, contrast_class=None):
+    """
+    Names of the contrasts between two segments of lang, optionally only
+    those of the specified contrast class ('C', 'V' or 'CV', see
+    contrast_table)
+    """
+    table = contrast_table(lang)
+    if not(contrast_class is None):
+        table = table[table['contrast class'] == contrast_class]
+    return table.index
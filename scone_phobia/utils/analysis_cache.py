@@ -0,0 +1,302 @@
+# -*- coding: utf-8 -*-
+"""
+Cache of resampled analysis results (see mp_scores.resample_analysis_cached).
+
+Applying an analysis to all resamples of the minimal-pair scores takes a
+while, so results are cached on disk. Cache entries are keyed by:
+  - the analysis function: its module, qualified name and source code, the
+    source of the module where it is defined, and recursively the values of
+    its default arguments and closure variables (arrays and pandas objects
+    being described by a hash of their content),
+  - the same for the filt, get_metadata and add_metadata functions,
+  - nboot, batchsize and the pickle encoding,
+  - the name, size and modification time of the input resample files.
+so that results are recomputed whenever any of these changes. Note that
+changes in other modules used by the analysis are not detected.
+
+Each entry is stored in the cache folder as a pickle with a .json file
+containing its description (name, analysis, size, creation and last use
+dates). Entries can be listed and pruned (removing least recently used
+entries first) with:
+    python analysis_cache.py list path/2/analysis_folder
+    python analysis_cache.py prune path/2/analysis_folder --max_size 10G
+"""
+
+import argparse
+import functools
+import hashlib
+import inspect
+import json
+import os
+import os.path as path
+import pickle
+import time
+import numpy as np
+import pandas
+import scone_phobia.utils.results_cache as results_cache
+
+
+# increment this if the content or format of cache entries changes
+CACHE_VERSION = 2
+
+
+def source_fingerprint(f):
+    # source code of f and of the module where it is defined, if available
+    try:
+        source = inspect.getsource(f)
+    except (OSError, TypeError):
+        source = None
+    try:
+        module_file = inspect.getsourcefile(f)
+    except TypeError:
+        module_file = None
+    if not(module_file is None) and path.exists(module_file):
+        module_source = results_cache.file_fingerprint(module_file)
+    else:
+        module_source = None
+    code = getattr(f, '__code__', None)
+    if source is None and not(code is None):
+        # e.g. functions defined interactively
+        source = (code.co_code.hex(), repr(code.co_consts), code.co_names)
+    return source, module_source
+
+
+def data_fingerprint(value):
+    # type, shape, dtypes and hash of the content of an array or of a
+    # pandas object
+    h = hashlib.sha1()
+    kind, shape = type(value).__name__, value.shape
+    if isinstance(value, np.ndarray) and value.dtype != object:
+        h.update(np.ascontiguousarray(value).tobytes())
+        dtypes = str(value.dtype)
+    else:
+        if isinstance(value, np.ndarray):
+            value = pandas.Series(value.ravel())
+        elif isinstance(value, pandas.Index):
+            value = value.to_series()
+        try:
+            hashes = pandas.util.hash_pandas_object(value, index=True)
+            h.update(hashes.values.tobytes())
+        except TypeError:
+            # unhashable elements
+            h.update(pickle.dumps(value))
+        if isinstance(value, pandas.DataFrame):
+            h.update(repr(list(value.columns)).encode('utf-8'))
+            dtypes = repr(list(value.dtypes.astype(str)))
+        else:
+            dtypes = str(value.dtype)
+    return (kind, shape, dtypes, h.hexdigest())
+
+
+def fingerprint(value, _seen=None):
+    """
+    Description of a value that can be hashed to get cache keys.
+    Functions are described by their code and by the values they use
+    through default arguments and closures.
+    """
+    if _seen is None:
+        _seen = set()
+    if id(value) in _seen:
+        return 'recursion'
+    if isinstance(value, functools.partial):
+        _seen = _seen | {id(value)}
+        return ('partial', fingerprint(value.func, _seen),
+                fingerprint(value.args, _seen),
+                fingerprint(value.keywords, _seen))
+    if inspect.isfunction(value) or inspect.ismethod(value):
+        _seen = _seen | {id(value)}
+        f = value.__func__ if inspect.ismethod(value) else value
+        closure = [] if f.__closure__ is None else \
+                    [cell.cell_contents for cell in f.__closure__]
+        return ('function', f.__module__, f.__qualname__,
+                source_fingerprint(f),
+                fingerprint(f.__defaults__, _seen),
+                fingerprint(f.__kwdefaults__, _seen),
+                fingerprint(closure, _seen))
+    if callable(value) and hasattr(value, '__qualname__'):
+        # builtins, classes
+        return ('callable', getattr(value, '__module__', None),
+                value.__qualname__)
+    if isinstance(value, (np.ndarray, pandas.DataFrame, pandas.Series,
+                          pandas.Index)):
+        # the repr of big arrays is truncated
+        return data_fingerprint(value)
+    if isinstance(value, (list, tuple)):
+        return tuple(fingerprint(e, _seen) for e in value)
+    if isinstance(value, dict):
+        return tuple(sorted((repr(k), fingerprint(v, _seen))
+                            for k, v in value.items()))
+    return repr(value)
+
+
+def files_fingerprint(folder, filt=None, files=None):
+    """
+    Name, size and modification time of resample files in folder
+    selected by filt.
+    files can be used to specify the names of the files to consider instead
+    of listing the folder, or a dict mapping them to their
+    (size, mtime_ns), as returned by catalog.select.
+    """
+    if filt is None:
+        filt = lambda x: True
+    if files is None:
+        files = os.listdir(folder)
+    res = []
+    for f in sorted(files):
+        model, ext = path.splitext(f)
+        if ext in ['.pickle', '.npz'] and filt(model):
+            if isinstance(files, dict):
+                size, mtime_ns = files[f]
+            else:
+                stat = os.stat(path.join(folder, f))
+                size, mtime_ns = stat.st_size, stat.st_mtime_ns
+            res.append((f, size, mtime_ns))
+    return res
+
+
+def cache_key(*params):
+    h = hashlib.sha1()
+    h.update(repr((CACHE_VERSION, fingerprint(params))).encode('utf-8'))
+    return h.hexdigest()
+
+
+def entry_files(cache_dir, name, key):
+    # the name of the entry is kept in the file names for readability
+    base = path.join(cache_dir, '{}__{}'.format(name, key[:16]))
+    return base + '.pickle', base + '.json'
+
+
+def save_info(info, info_file):
+    content = json.dumps(info, indent=2, sort_keys=True).encode('utf-8')
+    results_cache.atomic_save(info_file, lambda fh: fh.write(content))
+
+
+def cached(cache_dir, name, key, compute, description=None, verbose=0):
+    """
+    Return the result stored in cache_dir for key if it exists,
+    otherwise compute it with compute() and store it there (in a pickle).
+    description is an optional dict stored in the description of the entry.
+    """
+    entry_file, info_file = entry_files(cache_dir, name, key)
+    if path.exists(entry_file) and path.exists(info_file):
+        if verbose > 0:
+            print(("Using cached analysis results {}").format(entry_file))
+        with open(entry_file, 'rb') as fh:
+            res = pickle.load(fh)
+        with open(info_file, 'r') as fh:
+            info = json.load(fh)
+        info['last used'] = time.time()
+        save_info(info, info_file)
+    else:
+        if verbose > 0:
+            print(("No cached analysis results for {} found, "
+                   "computing them").format(name))
+        res = compute()
+        if not(path.exists(cache_dir)):
+            os.makedirs(cache_dir, exist_ok=True)
+        # the entry is only written once it is complete, in case
+        # several processes compute it concurrently
+        results_cache.atomic_save(entry_file, lambda fh: pickle.dump(res, fh))
+        now = time.time()
+        info = {'name': name, 'key': key, 'created': now, 'last used': now,
+                'size': os.stat(entry_file).st_size}
+        if not(description is None):
+            info.update(description)
+        save_info(info, info_file)
+    return res
+
+
+def list_entries(cache_dir):
+    """Descriptions of all entries in cache_dir, most recently used first"""
+    entries = []
+    for f in os.listdir(cache_dir):
+        if path.splitext(f)[1] == '.json':
+            info_file = path.join(cache_dir, f)
+            entry_file = path.splitext(info_file)[0] + '.pickle'
+            try:
+                with open(info_file, 'r') as fh:
+                    info = json.load(fh)
+            except ValueError:
+                continue  # not a cache entry
+            if not('key' in info) or not(path.exists(entry_file)):
+                continue
+            info['files'] = [entry_file, info_file]
+            entries.append(info)
+    entries.sort(key=lambda info: info['last used'], reverse=True)
+    return entries
+
+
+def prune(cache_dir, max_size=None, max_age=None, verbose=0):
+    """
+    Remove least recently used entries from cache_dir until their total
+    size is at most max_size bytes, and entries not used during the last
+    max_age seconds.
+    Returns the number of removed entries.
+    """
+    total = 0
+    nb_removed = 0
+    now = time.time()
+    for info in list_entries(cache_dir):
+        total = total + info['size']
+        too_big = not(max_size is None) and total > max_size
+        too_old = not(max_age is None) and now - info['last used'] > max_age
+        if too_big or too_old:
+            if verbose > 0:
+                print("Removing {}".format(info['files'][0]))
+            for f in info['files']:
+                os.remove(f)
+            nb_removed = nb_removed + 1
+    return nb_removed
+
+
+def parse_size(size):
+    # '500M' -> 500*2**20 bytes etc.
+    units = {'K': 2**10, 'M': 2**20, 'G': 2**30, 'T': 2**40}
+    if size[-1].upper() in units:
+        return int(float(size[:-1]) * units[size[-1].upper()])
+    return int(size)
+
+
+def format_size(size):
+    for unit in ['', 'K', 'M', 'G']:
+        if size < 1024:
+            break
+        size = size / 1024.
+    return '{:.1f}{}'.format(size, unit)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('command', choices=['list', 'prune'],
+                        help="list or prune cache entries")
+    parser.add_argument('cache_dir', help="analysis cache folder")
+    parser.add_argument('--max_size', default=None,
+                        help=("prune: remove least recently used entries until"
+                              " the total size is at most max_size bytes"
+                              " (suffixes K, M, G and T can be used)"))
+    parser.add_argument('--max_age', type=float, default=None,
+                        help="prune: remove entries not used for max_age days")
+    parser.add_argument('--all', action='store_true',
+                        help="prune: remove all entries")
+    args = parser.parse_args()
+    if args.command == 'list':
+        entries = list_entries(args.cache_dir)
+        for info in entries:
+            print("{}  {}  {:>8}  last used {}".format(
+                    info['name'], info.get('analysis', ''),
+                    format_size(info['size']),
+                    time.strftime('%Y-%m-%d %H:%M',
+                                  time.localtime(info['last used']))))
+        print("{} entries, {} in total".format(
+                len(entries), format_size(sum([e['size'] for e in entries]))))
+    else:
+        if args.all:
+            max_size = 0
+        elif args.max_size is None:
+            max_size = None
+        else:
+            max_size = parse_size(args.max_size)
+        max_age = None if args.max_age is None else args.max_age*24*3600
+        nb = prune(args.cache_dir, max_size=max_size, max_age=max_age,
+                   verbose=1)
+        print("Removed {} entries".format(nb))
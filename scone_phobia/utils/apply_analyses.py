@@ -41,6 +41,9 @@ import pandas
 import os
 import os.path as path
 import scone_phobia.utils.mp_scores as mp_scores
+import scone_phobia.utils.analysis_cache as analysis_cache
+import scone_phobia.utils.catalog as catalog
+import scone_phobia.analyses.contrast_sets as contrast_sets
 import yaml
 
 
@@ -157,14 +160,75 @@ def parse_bootres_fname(fpath, cfg=None):
 ## Fetch and analyse data  #
 ############################
 
+def catalog_files(folder, parse, where=None, refresh=False, verbose=0):
+    """
+    Metadata and (size, mtime_ns) of the files in folder matching where
+    (see catalog.select), obtained from the catalog of folder. The catalog is
+    created if it doesn't exist and updated if refresh is True.
+    """
+    if refresh or not(catalog.exists(folder)):
+        catalog.update(folder, parse, verbose=verbose)
+    return catalog.select(folder, where=where, with_stats=True)
+
+
+def files_metadata_getter(files, parse):
+    # get_metadata function using the metadata of files (from a catalog)
+    # if available, parsing filenames otherwise
+    if files is None:
+        return lambda x, parse=parse: parse(x)
+    return lambda x, files=files: files[path.basename(x)]
+
+
+def combine_analyses(analyses):
+    """
+    Analysis applying each analysis of the dict analyses and returning a dict
+    of results with the same keys, so that several analyses can be computed
+    from a single load of the (possibly resampled) minimal-pair scores.
+    Contrast-set analyses share a single pass over the data (see
+    contrast_sets.run_analyses).
+    The combined analysis is replicate_vectorized only if all analyses are,
+    so that resamples are not stacked together for analyses applied
+    separately to each of them.
+    """
+    def combined(df):
+        if not('boot ID' in df.columns):
+            return contrast_sets.run_analyses(df, analyses)
+        vectorized = {name: analysis for name, analysis in analyses.items()
+                      if mp_scores.is_replicate_vectorized(analysis)}
+        res = contrast_sets.run_analyses(df, vectorized)
+        for name, analysis in analyses.items():
+            if not(name in res):
+                res[name] = pandas.concat([analysis(boot_df) for _, boot_df
+                                           in df.groupby('boot ID', sort=True)])
+        return {name: res[name] for name in analyses}
+    if all([mp_scores.is_replicate_vectorized(analysis)
+            for analysis in analyses.values()]):
+        combined = mp_scores.replicate_vectorized(combined)
+    return combined
+
+
+def concat_results(results):
+    # concatenate resampled analysis results, entry by entry for
+    # combined analyses
+    if results and isinstance(results[0], dict):
+        return {name: pandas.concat([res[name] for res in results])
+                for name in results[0]}
+    return pandas.concat(results)
+
+
 def fetch_data(analysis, mp_folder, filt=None, encoding=None,
-               add_metadata=None):
-    """Use the above to get just the right data"""
-    get_metadata = lambda x, parse=parse_res_fname: parse(x)
+               add_metadata=None, files=None):
+    """
+    Use the above to get just the right data.
+    files: if specified, dict mapping the names of the files in mp_folder to
+        consider to their metadata (see catalog_files)
+    """
+    get_metadata = files_metadata_getter(files, parse_res_fname)
     df = mp_scores.load_mp_errors(mp_folder,
                                   get_metadata,
                                   filt=filt,
-                                  encoding=encoding) # load all mp scores in a big df
+                                  encoding=encoding,
+                                  files=files) # load all mp scores in a big df
     if not(add_metadata is None):
         df = add_metadata(df)
     df = analysis(df)
@@ -177,11 +241,26 @@ def fetch_resampled_data(analysis,
                          filt=None,
                          encoding=None,
                          add_metadata=None,
-                         verbose=0):
+                         verbose=0,
+                         accumulator=None,
+                         keep_boot=True,
+                         boot_chunksize=None,
+                         n_jobs=1,
+                         files=None,
+                         file_stats=None):
     # Getting resampled minimal-pair scores to estimate variability.
     # This can take time so if resampling_file is not None,
-    # results are saved once they are computed
-    get_metadata = lambda x, parse=parse_bootres_fname: parse(x)
+    # results are saved once they are computed.
+    # If accumulator is not None, each resampled result is added to it, and
+    # if keep_boot is False, resampled results are not returned.
+    # files and file_stats: metadata and (size, mtime_ns) of the files to
+    # consider, as returned by catalog_files (all files by default).
+    if not(files is None) and not(filt is None):
+        # only keep the metadata of the selected files, as get_metadata is
+        # part of the key of cached results
+        files = {f: metadata for f, metadata in files.items()
+                 if filt(path.splitext(f)[0])}
+    get_metadata = files_metadata_getter(files, parse_bootres_fname)
     if resampling_file is None:
         boot_dfs = mp_scores.resample_analysis(analysis,
                                                resampled_mp_folder,
@@ -189,7 +268,12 @@ def fetch_resampled_data(analysis,
                                                filt=filt,
                                                encoding=encoding,
                                                add_metadata=add_metadata,
-                                               verbose=verbose)
+                                               verbose=verbose,
+                                               accumulator=accumulator,
+                                               keep=keep_boot,
+                                               boot_chunksize=boot_chunksize,
+                                               n_jobs=n_jobs,
+                                               files=files)
     else:
         boot_dfs = mp_scores.resample_analysis_cached(resampling_file,
                                                       analysis,
@@ -198,22 +282,39 @@ def fetch_resampled_data(analysis,
                                                       filt=filt,
                                                       encoding=encoding,
                                                       add_metadata=add_metadata,
-                                                      verbose=verbose)
-    boot_df = pandas.concat(boot_dfs)
+                                                      verbose=verbose,
+                                                      boot_chunksize=boot_chunksize,
+                                                      n_jobs=n_jobs,
+                                                      files=file_stats)
+        if not(accumulator is None):
+            for boot_df in boot_dfs:
+                accumulator.add(boot_df)
+    if keep_boot:
+        boot_df = concat_results(boot_dfs)
+    else:
+        boot_df = None
     return boot_df
 
 
-def resampling_filts(resample_caching_scheme, mp_folder, user_filt=None):
+def resampling_filts(resample_caching_scheme, mp_folder, user_filt=None,
+                     files=None):
     """
     Function used to specify various way of caching resamples of analysis
     results.
     It is the responsibility of this function to ensure that all
     caching filters are consistent with user_filt.
+    files: if specified, dict mapping the names of the files in mp_folder to
+        consider to their metadata (see catalog_files)
     See apply_analysis below.
     TODO? Could add a scheme where caching is done by type of model.
     """
     caching_filts = []
-    mp_files = [path.splitext(e)[0] for e in os.listdir(mp_folder)
+    if files is None:
+        files = os.listdir(mp_folder)
+        parse = parse_res_fname
+    else:
+        parse = lambda mp_fname, files=files: files[mp_fname + '.pickle']
+    mp_files = [path.splitext(e)[0] for e in files
                 if path.splitext(e)[1] == '.pickle']
     if resample_caching_scheme == 'mp_file':
         for mp_fname in mp_files:
@@ -229,11 +330,11 @@ def resampling_filts(resample_caching_scheme, mp_folder, user_filt=None):
         for mp_fname1 in mp_files:
             # only use caching filters useful given user-provided filt
             if user_filt(mp_fname1):
-                metadata1 = dict(parse_res_fname(mp_fname1))
+                metadata1 = dict(parse(mp_fname1))
                 for mp_fname2 in mp_files:
                     # only use caching filters useful given user-provided filt
                     if user_filt(mp_fname2):
-                        metadata2 = dict(parse_res_fname(mp_fname2))
+                        metadata2 = dict(parse(mp_fname2))
                         if metadata1['test set'] == metadata2['test set']:
                             filt_name = mp_fname1 + '___' + mp_fname2  # hacky
                             # use args default values to avoid scope issues
@@ -254,11 +355,27 @@ def apply_analysis(analysis, mp_folder,
                    analysis_folder=None,
                    pickle_encoding=None,
                    resampled_pickle_encoding="latin1",
+                   keep_boot=False,
+                   ci=None,
+                   boot_chunksize=None,
+                   n_jobs=1,
+                   cache_max_size=None,
+                   where=None,
+                   use_catalog=False,
+                   refresh_catalog=False,
                    verbose=0):
     """
     analysis: function that takes a pandas dataframe containing all
         required minimal-pair scores and returns the analysis results
         of interest (in a pandas dataframe if resampling=True).
+        Can also be a dict of such functions, e.g.
+            {'avg_error': avg_error, 'RL_AmEnglish': RL_AmEnglish}
+        in which case all analyses are computed from a single load of the
+        minimal-pair scores (and of their resamples) and dicts with the
+        same keys are returned instead of dataframes (for the results,
+        standard deviation estimates included, and for the bootstrapped
+        data). With resample caching, the cache files are then shared by
+        all analyses in the dict.
     mp_folder: folder where the pickles containing minimal-pair scores are stored
         if resampling=True, mp_folder should also contain a 'resampling' subfolder
         where pickles containing resampled versions of the minimal-pair scores
@@ -272,8 +389,10 @@ def apply_analysis(analysis, mp_folder,
         config.yml file) and adds some additional metadata columns to it
     resampling: whether or not to use resampling. Currently, this is only
         supported for minimal pairs averaged on speaker first then on context.
-        This returns the full bootstrapped data and also adds resampling-based
-        standard deviation estimate to the analysis results.
+        This adds resampling-based standard deviation estimates to the
+        analysis results, computed on the fly as each resample is analysed,
+        and returns a (results, bootstrapped data) pair, where the
+        bootstrapped data is None unless keep_boot is True.
     resample_caching_scheme: if resampling is True, determines whether and how
         to cache resampled analysis results. Caching results on disk is useful:
             - if applying the analysis on resamples takes too long (if there are
@@ -300,19 +419,82 @@ def apply_analysis(analysis, mp_folder,
                 (features/dissimilarity function couples). **
     analysis_folder: currently only used if resampling=True and
         resample_caching_scheme is not None, to specify where to store cached
-        analysis resamples.
+        analysis resamples. Cached results are automatically recomputed if
+        the analysis, filt or add_metadata functions or the resampled
+        minimal-pair scores change (see analysis_cache.py).
     pickle_encoding and resampled_pickle_encoding: useful to ensure pickles
         containing minimal pair scores, resp. resampled versions of those, will be
         read correctly, for example if they have been computed under a different 
         python environment than the current one.
+    keep_boot: if resampling=True, whether to keep and return the full
+        bootstrapped data (all resampled analysis results concatenated).
+        This can use a lot of memory for analyses with many rows.
+    ci: if resampling=True, level (in %, e.g. 95) of percentile confidence
+        intervals to add to the analysis results ('ci low' and 'ci high'
+        columns). By default, only standard deviations are added.
+        Intervals are exact percentiles, so that all resampled values of
+        the analysis results are kept until the end (about 12 bytes per
+        line of results per resample, i.e. O(nboot x lines) memory, while
+        standard deviations only need O(lines)).
+    boot_chunksize: if resampling=True, for analyses declared with the
+        mp_scores.replicate_vectorized decorator, resamples are passed to the
+        analysis one batch at a time by default. If specified, consecutive
+        batches are passed together, by chunks of at least boot_chunksize
+        resamples (more memory, fewer calls). Other analyses are applied
+        separately to each resample.
+    n_jobs: if resampling=True, number of worker processes. If
+        resample_caching_scheme is None, batches of resamples are distributed
+        among the workers, otherwise the cache files are. Results are merged
+        in a deterministic order (standard deviations only depend on n_jobs
+        through floating-point rounding).
+    cache_max_size: if specified, once the analysis is done, least recently
+        used cached analysis resamples in analysis_folder are removed until
+        their total size is at most cache_max_size bytes.
+    where: dict mapping primary metadata keys (e.g. 'test set') to a value
+        or a list of accepted values. Only files whose metadata match are
+        included in the analysis (in addition to filt). Files are selected
+        through the catalogs of mp_folder and of its 'resampling' subfolder
+        (see catalog.py), without listing these folders.
+    use_catalog: whether to select files through the catalogs even if where
+        is not specified. Catalogs are created if they do not exist yet.
+    refresh_catalog: whether to update the catalogs before selecting files,
+        e.g. if minimal-pair scores have been added since their creation.
     """
+    if isinstance(analysis, dict):
+        analyses = analysis
+        analysis = combine_analyses(analyses)
+    else:
+        analyses = None
     if filt is None:
         filt = lambda mp_fname: True 
+    use_catalog = use_catalog or refresh_catalog or not(where is None)
+    resampled_mp_folder = path.join(mp_folder, 'resampling')
+    if use_catalog:
+        files, _ = catalog_files(mp_folder, parse_res_fname, where=where,
+                                 refresh=refresh_catalog, verbose=verbose)
+        if resampling:
+            boot_files, boot_file_stats = catalog_files(resampled_mp_folder,
+                                                        parse_bootres_fname,
+                                                        where=where,
+                                                        refresh=refresh_catalog,
+                                                        verbose=verbose)
+    else:
+        files, boot_files, boot_file_stats = None, None, None
     df = fetch_data(analysis, mp_folder, filt=filt, encoding=pickle_encoding,
-                    add_metadata=add_metadata)
+                    add_metadata=add_metadata, files=files)
     if resampling:
+        if analyses is None:
+            accumulator = mp_scores.BootstrapAccumulator(
+                        resampled_cols=mp_scores.analysis_resampled_cols(analysis),
+                        ci=ci)
+        else:
+            # one accumulator per analysis, each with its own resampled columns
+            accumulator = mp_scores.BootstrapAccumulators(
+                {name: mp_scores.BootstrapAccumulator(
+                        resampled_cols=mp_scores.analysis_resampled_cols(f),
+                        ci=ci)
+                 for name, f in analyses.items()})
         boot_dfs = []
-        resampled_mp_folder = path.join(mp_folder, 'resampling')
         if resample_caching_scheme is None:
             resampling_file = None
             boot_dfs.append(
@@ -321,13 +503,20 @@ def apply_analysis(analysis, mp_folder,
                                      filt=filt,
                                      encoding=resampled_pickle_encoding,
                                      add_metadata=add_metadata,
-                                     verbose=verbose))
+                                     verbose=verbose,
+                                     accumulator=accumulator,
+                                     keep_boot=keep_boot,
+                                     boot_chunksize=boot_chunksize,
+                                     n_jobs=n_jobs,
+                                     files=boot_files))
         else:
             caching_filts = resampling_filts(resample_caching_scheme,
                                              mp_folder,
-                                             user_filt=filt)
+                                             user_filt=filt,
+                                             files=files)
             assert not(analysis_folder is None)
-            for filt_name, caching_filt in caching_filts:
+            def fetch_shard(caching_filt_item):
+                filt_name, caching_filt = caching_filt_item
                 # keep and_filt in case we add other resampling caching schemes
                 # where the caching filts are defined more coarsely than some
                 # possible user-provided filters.
@@ -335,16 +524,36 @@ def apply_analysis(analysis, mp_folder,
                                 f1(mp_fname) and f2(mp_fname)
                 resampling_file = path.join(analysis_folder,
                                             '{}.pickle'.format(filt_name))
-                boot_dfs.append(
-                    fetch_resampled_data(analysis, resampling_file,
-                                         resampled_mp_folder,
-                                         filt=and_filt,
-                                         encoding=resampled_pickle_encoding,
-                                         add_metadata=add_metadata,
-                                         verbose=verbose))
-        boot_df = pandas.concat(boot_dfs)
+                # each shard gets its own accumulator, so that shards can be
+                # processed in separate processes
+                shard_accumulator = accumulator.empty_copy()
+                boot_df = fetch_resampled_data(analysis, resampling_file,
+                                               resampled_mp_folder,
+                                               filt=and_filt,
+                                               encoding=resampled_pickle_encoding,
+                                               add_metadata=add_metadata,
+                                               verbose=verbose,
+                                               accumulator=shard_accumulator,
+                                               keep_boot=keep_boot,
+                                               boot_chunksize=boot_chunksize,
+                                               files=boot_files,
+                                               file_stats=boot_file_stats)
+                return boot_df, shard_accumulator
+            # shards are merged in the order of caching_filts
+            for boot_df, shard_accumulator in mp_scores.fork_map(fetch_shard,
+                                                                 caching_filts,
+                                                                 n_jobs):
+                boot_dfs.append(boot_df)
+                accumulator.merge(shard_accumulator)
+            if not(cache_max_size is None):
+                analysis_cache.prune(analysis_folder, max_size=cache_max_size,
+                                     verbose=verbose)
+        if keep_boot:
+            boot_df = concat_results(boot_dfs)
+        else:
+            boot_df = None
         # Add resulting standard deviation estimates to main dataframe 
-        df = mp_scores.estimate_std(df, boot_df)
+        df = accumulator.add_std(df)
         # TODO: permutation tests
         return df, boot_df
     else:
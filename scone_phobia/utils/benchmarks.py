@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks for the performance-critical parts of scone_phobia.
+
+Each benchmark can be run either on synthetic data or on an actual
+ABXpy results file, so that timings obtained on the machines where
+the analyses are actually run can be reported.
+
+Usage examples:
+    python benchmarks.py parse_by
+    python benchmarks.py parse_by --result_file path/2/ABXpy/results.txt
+    python benchmarks.py load_mp_errors
+    python benchmarks.py load_mp_errors --mp_folder path/2/mpscores
+"""
+
+import argparse
+import ast
+import os
+import os.path as path
+import pickle
+import shutil
+import tempfile
+import time
+import tracemalloc
+import numpy as np
+import pandas
+import scone_phobia.utils.mp_scores as mp_scores
+import scone_phobia.utils.apply_analyses as apply_analyses
+
+
+def synthetic_by_column(n_rows, n_speakers=20, n_contexts=40, seed=0):
+    """
+    'by' column similar to the ones found in ABXpy results files
+    for tasks ON phone BY speaker, previous and following phones.
+    """
+    rng = np.random.RandomState(seed)
+    spks = ['s{:02d}'.format(i) for i in range(n_speakers)]
+    cons = ['P{:02d}'.format(i) for i in range(n_contexts)]
+    by = ["('{}', '{}', '{}')".format(spks[s], cons[p], cons[n])
+          for s, p, n in zip(rng.randint(n_speakers, size=n_rows),
+                             rng.randint(n_contexts, size=n_rows),
+                             rng.randint(n_contexts, size=n_rows))]
+    return pandas.DataFrame({'by': by})
+
+
+def parse_by_reference(df, by_columns):
+    # row-by-row parser, as used before mp_scores.parse_by was vectorized
+    arr = np.array([e for e in map(ast.literal_eval, df['by'])])
+    for i, by in enumerate(by_columns):
+        df[by] = arr[:,i]
+    del df['by']
+    return df
+
+
+def timeit(f, *args, **kwargs):
+    t = time.time()
+    res = f(*args, **kwargs)
+    return res, time.time()-t
+
+
+def bench_parse_by(result_file=None, n_rows=10**6, n_repeats=3):
+    by_columns = ['speaker', 'prev-phone', 'next-phone']
+    if result_file is None:
+        df = synthetic_by_column(n_rows)
+    else:
+        df = pandas.read_csv(result_file, sep='\t', usecols=['by'])
+    n = len(df)
+    print("parse_by benchmark on {} rows".format(n))
+    for name, parse in [('reference', parse_by_reference),
+                        ('mp_scores.parse_by', mp_scores.parse_by)]:
+        durations = []
+        for _ in range(n_repeats):
+            res, duration = timeit(parse, df.copy(), by_columns)
+            durations.append(duration)
+        if name == 'reference':
+            ref = res
+        else:
+            res = mp_scores.decode(res)
+            assert res.equals(ref), "parse_by output differs from reference"
+        duration = min(durations)
+        print("  {}: {:.3f}s, {:.0f} rows/s".format(name, duration,
+                                                    n/duration))
+
+
+def synthetic_mp_folder(folder, n_models, n_phones=40, seed=0):
+    """
+    Folder with one pickle of (encoded) mp scores per model, named as
+    expected by apply_analyses.parse_res_fname.
+    """
+    rng = np.random.RandomState(seed)
+    phones = ['P{:02d}'.format(i) for i in range(n_phones)]
+    contrasts = [mp_scores.mp_contrast_name(p1, p2)
+                 for i, p1 in enumerate(phones) for p2 in phones[i+1:]]
+    for i in range(n_models):
+        df = pandas.DataFrame({'contrast': contrasts,
+                               'score': rng.rand(len(contrasts))})
+        df = mp_scores.encode(df, cfg={'phone_1': 'phone_1',
+                                       'phone_2': 'phone_2',
+                                       'prev-phone': 'prev-phone',
+                                       'next-phone': 'next-phone',
+                                       'speaker': 'speaker'})
+        name = 'model{}model__Atrain__Btest__KLdis.pickle'.format(i)
+        with open(path.join(folder, name), 'wb') as fh:
+            pickle.dump(df, fh)
+
+
+def load_mp_errors_reference(folder, get_metadata):
+    # loader used before load_mp_errors built metadata as categoricals
+    dfs = []
+    for f in os.listdir(folder):
+        model, ext = path.splitext(f)
+        if ext == '.pickle':
+            with open(path.join(folder, f), 'rb') as fh:
+                df_model = pickle.load(fh)
+            metadata = get_metadata(path.join(folder, f))
+            for name, value in metadata:
+                df_model[name] = value
+            dfs.append(df_model)
+    df = pandas.concat(dfs)
+    df = mp_scores.decode(df)
+    df['error'] = 100*(1-df['score'].astype(np.float64))
+    del df['score']
+    return df
+
+
+def memit(f, *args, **kwargs):
+    # result, duration, retained and peak memory allocated by f (in bytes)
+    tracemalloc.start()
+    t = time.time()
+    res = f(*args, **kwargs)
+    duration = time.time()-t
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return res, duration, current, peak
+
+
+def bench_load_mp_errors(mp_folder=None, n_models=200):
+    if mp_folder is None:
+        folder = tempfile.mkdtemp()
+        synthetic_mp_folder(folder, n_models)
+    else:
+        folder = mp_folder
+    get_metadata = apply_analyses.parse_res_fname
+    try:
+        for name, load in [('reference', load_mp_errors_reference),
+                           ('mp_scores.load_mp_errors',
+                            mp_scores.load_mp_errors)]:
+            res, duration, current, peak = memit(load, folder, get_metadata)
+            if name == 'reference':
+                ref = res
+                print("load_mp_errors benchmark on {} rows".format(len(res)))
+            else:
+                res = mp_scores.decode(res.copy())
+                assert res.reset_index(drop=True).equals(
+                        ref.reset_index(drop=True)), \
+                    "load_mp_errors output differs from reference"
+            print(("  {}: {:.3f}s, {:.1f}MB retained, {:.1f}MB peak"
+                   ).format(name, duration, current/2.**20, peak/2.**20))
+    finally:
+        if mp_folder is None:
+            shutil.rmtree(folder)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('benchmark', choices=['parse_by', 'load_mp_errors'],
+                        help="benchmark to run")
+    parser.add_argument('--result_file', default=None,
+                        help=("ABXpy results file to use instead of "
+                              "synthetic data"))
+    parser.add_argument('--n_rows', type=int, default=10**6,
+                        help="number of rows of synthetic data")
+    parser.add_argument('--mp_folder', default=None,
+                        help=("load_mp_errors: folder of mp scores to use "
+                              "instead of synthetic data"))
+    parser.add_argument('--n_models', type=int, default=200,
+                        help=("load_mp_errors: number of models in synthetic "
+                              "data"))
+    parser.add_argument('--n_repeats', type=int, default=3,
+                        help="best timing over n_repeats runs is reported")
+    args = parser.parse_args()
+    if args.benchmark == 'parse_by':
+        bench_parse_by(args.result_file, args.n_rows, args.n_repeats)
+    elif args.benchmark == 'load_mp_errors':
+        bench_load_mp_errors(args.mp_folder, args.n_models)
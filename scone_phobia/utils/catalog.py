@@ -0,0 +1,195 @@
+# -*- coding: utf-8 -*-
+"""
+Catalog of the minimal-pair scores files in a folder.
+
+Selecting files by listing a folder and parsing the name of each file (see
+apply_analyses.parse_res_fname) gets slow for folders with thousands of
+resample batch files, in particular on network filesystems. A catalog
+stores, in a SQLite database in the folder itself, the name, size and
+modification time of each file together with the metadata parsed from its
+name (including batch ID and batch size for resample files).
+
+The catalog is updated incrementally: only new or modified files are parsed
+again and deleted files are forgotten. Files can then be selected by
+metadata values directly in the database (see select), without touching the
+folder. precompute_mp_scores.py and resample_mp_scores.py update the catalogs
+of their output folders, but the catalog is not updated automatically when
+files are added to the folder by other means, update it with:
+    python catalog.py update path/2/mpscores
+    python catalog.py update path/2/mpscores/resampling --resampling
+or with the refresh_catalog argument of apply_analysis. Files can be listed
+with:
+    python catalog.py list path/2/mpscores --where "test set=WSJ"
+"""
+
+import argparse
+import os
+import os.path as path
+import sqlite3
+import time
+
+
+CATALOG_FILE = 'catalog.sqlite'
+# increment this if the content or format of the catalog changes
+CATALOG_VERSION = 1
+EXTENSIONS = ['.pickle', '.npz']
+
+
+def connect(folder):
+    """Connection to the catalog of folder, created empty if needed"""
+    con = sqlite3.connect(path.join(folder, CATALOG_FILE), timeout=60)
+    version = con.execute("PRAGMA user_version").fetchone()[0]
+    if version != CATALOG_VERSION:
+        # catalogs can always be rebuilt from the folder
+        with con:
+            con.execute("DROP TABLE IF EXISTS metadata")
+            con.execute("DROP TABLE IF EXISTS files")
+            con.execute(("CREATE TABLE files (name TEXT PRIMARY KEY,"
+                         " size INTEGER, mtime_ns INTEGER)"))
+            # one row per (file, metadata key), pos gives the order of the
+            # keys in the metadata of the file
+            con.execute(("CREATE TABLE metadata (name TEXT, pos INTEGER,"
+                         " key TEXT, value, PRIMARY KEY (name, key))"))
+            con.execute("CREATE INDEX metadata_key ON metadata (key, value)")
+            con.execute("PRAGMA user_version = {}".format(CATALOG_VERSION))
+    return con
+
+
+def exists(folder):
+    return path.exists(path.join(folder, CATALOG_FILE))
+
+
+def update(folder, parse, verbose=0):
+    """
+    Update the catalog of folder: files (with a .pickle or .npz extension)
+    that are new or whose size or modification time changed are parsed with
+    parse (a function taking a file path and returning a list of key, value
+    pairs, see apply_analyses.parse_res_fname) and deleted files are removed.
+    Files whose name can't be parsed are skipped.
+    Returns the number of parsed and removed files.
+    """
+    con = connect(folder)
+    try:
+        known = {name: (size, mtime_ns) for name, size, mtime_ns
+                 in con.execute("SELECT name, size, mtime_ns FROM files")}
+        found = {}
+        for entry in os.scandir(folder):
+            if path.splitext(entry.name)[1] in EXTENSIONS:
+                stat = entry.stat()
+                found[entry.name] = (stat.st_size, stat.st_mtime_ns)
+        changed = [name for name in sorted(found)
+                   if known.get(name) != found[name]]
+        removed = [name for name in known if not(name in found)]
+        with con:
+            for name in removed + changed:
+                con.execute("DELETE FROM files WHERE name=?", (name,))
+                con.execute("DELETE FROM metadata WHERE name=?", (name,))
+            for name in changed:
+                try:
+                    metadata = parse(path.join(folder, name))
+                except AssertionError:
+                    if verbose > 0:
+                        print("Skipping {} (unparsable name)".format(name))
+                    continue
+                con.execute("INSERT INTO files VALUES (?, ?, ?)",
+                            (name,) + found[name])
+                con.executemany("INSERT INTO metadata VALUES (?, ?, ?, ?)",
+                                [(name, pos, key, value) for pos, (key, value)
+                                 in enumerate(metadata)])
+    finally:
+        con.close()
+    if verbose > 0:
+        print(("Catalog of {}: {} files parsed, {} removed"
+               ).format(folder, len(changed), len(removed)))
+    return len(changed), len(removed)
+
+
+def where_clause(where):
+    # SQL condition (and its parameters) selecting files whose metadata
+    # match where (see select)
+    conditions, params = [], []
+    for key in sorted(where):
+        values = where[key]
+        if not(isinstance(values, (list, tuple, set))):
+            values = [values]
+        values = list(values)
+        # values are compared as strings, so that e.g. batch IDs can be
+        # given as 3 or '3'
+        conditions.append(("name IN (SELECT name FROM metadata WHERE key=?"
+                           " AND CAST(value AS TEXT) IN ({}))"
+                           ).format(", ".join(["?"]*len(values))))
+        params = params + [key] + [str(value) for value in values]
+    if not(conditions):
+        return "", []
+    return "WHERE " + " AND ".join(conditions), params
+
+
+def select(folder, where=None, with_stats=False):
+    """
+    Files in the catalog of folder whose metadata match where, as a dict
+    mapping file names to their metadata (list of key, value pairs).
+
+    where is a dict mapping metadata keys (e.g. 'test set' or 'batch ID')
+    to a value or to a list of accepted values, e.g.
+        {'test set': 'WSJ', 'model type': ['AMtri', 'mfcc']}
+
+    If with_stats is True, (size, mtime_ns) of the files are also returned,
+    in a second dict.
+    """
+    if where is None:
+        where = {}
+    con = connect(folder)
+    try:
+        clause, params = where_clause(where)
+        stats = {name: (size, mtime_ns) for name, size, mtime_ns
+                 in con.execute(("SELECT name, size, mtime_ns FROM files {}"
+                                 ).format(clause), params)}
+        files = {name: [] for name in sorted(stats)}
+        rows = con.execute(("SELECT name, key, value FROM metadata {}"
+                            " ORDER BY name, pos").format(clause), params)
+        for name, key, value in rows:
+            files[name].append((key, value))
+    finally:
+        con.close()
+    if with_stats:
+        return files, stats
+    return files
+
+
+def parse_where(conditions):
+    # ['test set=WSJ', 'test set=CSJ', ...] -> {'test set': ['WSJ', 'CSJ']}
+    where = {}
+    for condition in conditions:
+        key, value = condition.split('=', 1)
+        where.setdefault(key, []).append(value)
+    return where
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('command', choices=['update', 'list'],
+                        help="update or list the catalog")
+    parser.add_argument('folder', help="folder of minimal-pair scores")
+    parser.add_argument('--resampling', action='store_true',
+                        help=("the folder contains resampled minimal-pair"
+                              " scores"))
+    parser.add_argument('--where', action='append', default=[],
+                        help=("list: only list files with the specified"
+                              " metadata value ('key=value', can be"
+                              " repeated)"))
+    args = parser.parse_args()
+    if args.command == 'update':
+        import scone_phobia.utils.apply_analyses as apply_analyses
+        if args.resampling:
+            parse = apply_analyses.parse_bootres_fname
+        else:
+            parse = apply_analyses.parse_res_fname
+        update(args.folder, parse, verbose=1)
+    else:
+        files, stats = select(args.folder, parse_where(args.where),
+                              with_stats=True)
+        for name in files:
+            print("{}  {}".format(name, time.strftime(
+                    '%Y-%m-%d %H:%M',
+                    time.localtime(stats[name][1]/10.**9))))
+        print("{} files".format(len(files)))
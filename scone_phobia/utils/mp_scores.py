@@ -21,11 +21,17 @@ library being called by several libraries applied to particular tasks.
 
 import numpy as np
 import ast
+import json
 import pandas
 import os
 import os.path as path
 import pickle
+import traceback
+import multiprocessing
 import oyaml as yaml
+import scone_phobia.utils.results_cache as results_cache
+import scone_phobia.utils.resample_store as resample_store
+import scone_phobia.utils.analysis_cache as analysis_cache
 
 
 def load_cfg_from_file(f):
@@ -41,26 +47,136 @@ def load_cfg_from_file(f):
     return wrapper
 
 
+############
+# Encoding #
+############
+# Phones, speakers and contrasts are stored as pandas.Categorical columns,
+# i.e. as integer codes plus a vocabulary, and scores as single precision
+# floats, from the parsing of the ABXpy results files to the saved mp scores.
+# Vocabularies are sorted, so that sorting on codes is the same as sorting on
+# the original strings, and the same phone vocabulary is shared by the
+# phone_1, phone_2, prev-phone and next-phone columns of a same DataFrame.
+# Decoding back to strings is done by load_mp_errors, before passing the
+# mp scores to analyses.
+
+SCORE_DTYPE = np.float32
+
+
+def is_encoded(col):
+    return isinstance(col.dtype, pandas.api.types.CategoricalDtype)
+
+
+def vocabulary(cols):
+    """Sorted array of all the distinct values found in a list of columns"""
+    values = []
+    for col in cols:
+        if is_encoded(col):
+            values.append(np.asarray(col.cat.categories, dtype=object))
+        else:
+            values.append(pandas.unique(np.asarray(col, dtype=object)))
+    return np.unique(np.concatenate(values))
+
+
+def encode_col(col, vocab):
+    if is_encoded(col):
+        return col.cat.set_categories(vocab)
+    else:
+        return pandas.Categorical(col, categories=vocab)
+
+
+@load_cfg_from_file
+def encode(df, cfg=None):
+    """
+    Dictionary-encode the phone, speaker and contrast columns of df
+    and store scores in compact format (df is modified in place).
+    """
+    phone_cols = [cfg[e] for e in ['phone_1', 'phone_2',
+                                   'prev-phone', 'next-phone']
+                  if cfg[e] in df]
+    if phone_cols:
+        phones = vocabulary([df[col] for col in phone_cols])
+        for col in phone_cols:
+            df[col] = encode_col(df[col], phones)
+    for col in [cfg['speaker'], 'contrast']:
+        if col in df:
+            df[col] = encode_col(df[col], vocabulary([df[col]]))
+    if 'score' in df:
+        df['score'] = df['score'].astype(SCORE_DTYPE)
+    return df
+
+
+def group_keys(df, cols):
+    # group on the integer codes of encoded columns rather than on the
+    # categoricals themselves: this is faster and the order of the groups
+    # (sorted by codes, i.e. by strings) does not depend on the pandas version
+    return [df[col].cat.codes.rename(col) if is_encoded(df[col]) else df[col]
+            for col in cols]
+
+
+def restore_encoding(res, df, cols):
+    # get back encoded columns after grouping on group_keys(df, cols)
+    for col in cols:
+        if is_encoded(df[col]):
+            res[col] = pandas.Categorical.from_codes(res[col].values,
+                                                     df[col].cat.categories)
+    return res
+
+
+def decode(df):
+    """Replace dictionary-encoded columns of df by plain string columns"""
+    for col in df.columns:
+        if is_encoded(df[col]):
+            df[col] = df[col].astype(object)
+    return df
+
+
 #######################
 # Loading raw results #
 #######################
 # Should be changed if the format of results produced by ABXpy changes
 
 def parse_by(df, by_columns):
-    arr = np.array([e for e in map(ast.literal_eval, df['by'])])
+    # The 'by' column only takes as many distinct values as there are
+    # (speaker, previous phone, next phone) triplets, which is orders of
+    # magnitude less than the number of rows in the results file, so
+    # we only parse the unique values and broadcast them back on the rows.
+    codes, uniques = pandas.factorize(df['by'])
+    arr = np.array([e for e in map(ast.literal_eval, uniques)])
     for i, by in enumerate(by_columns):
         assert not by in df
-        df[by] = arr[:,i]
+        vocab, by_codes = np.unique(arr[:,i], return_inverse=True)
+        df[by] = pandas.Categorical.from_codes(by_codes[codes],
+                                               vocab.astype(object))
     del df['by']
     return df
 
 
-def load_df(result_file, cols):
-    df = pandas.read_csv(result_file, sep='\t')
+def read_csv_args(cfg):
+    # read phones directly as categoricals and scores in compact format
+    return {'sep': '\t', 'dtype': {cfg['phone_1']: 'category',
+                                   cfg['phone_2']: 'category',
+                                   'score': SCORE_DTYPE}}
+
+
+@load_cfg_from_file
+def load_df(result_file, cols, cfg=None):
+    df = pandas.read_csv(result_file, **read_csv_args(cfg))
     df = parse_by(df, cols)
+    df = encode(df, cfg=cfg)
     return df
 
 
+@load_cfg_from_file
+def load_df_chunks(result_file, cols, chunksize, cfg=None):
+    """
+    Same as load_df, but iterating over successive blocks of at most
+    chunksize lines of the results file.
+    """
+    for df in pandas.read_csv(result_file, chunksize=chunksize,
+                              **read_csv_args(cfg)):
+        yield encode(parse_by(df, cols), cfg=cfg)
+
+
 #############################
 # Getting symetrized scores #
 #############################
@@ -69,18 +185,54 @@ def load_df(result_file, cols):
 def add_contrast_col(df, col_phone1, col_phone2):
     # a utility function
     if not('contrast' in df):
-        contrast_name = lambda p1, p2: p1+'-'+p2 if p1<=p2 else p2+'-'+p1
-        df['contrast'] = [contrast_name(p1,p2) for p1, p2 in zip(df[col_phone1],
-                                                                 df[col_phone2])]
+        if is_encoded(df[col_phone1]) and is_encoded(df[col_phone2]) and \
+                df[col_phone1].cat.categories.equals(df[col_phone2].cat.categories):
+            df['contrast'] = encoded_contrasts(df[col_phone1], df[col_phone2])
+        else:
+            contrast_name = lambda p1, p2: p1+'-'+p2 if p1<=p2 else p2+'-'+p1
+            df['contrast'] = [contrast_name(p1,p2) for p1, p2 in zip(df[col_phone1],
+                                                                     df[col_phone2])]
     return df
 
 
+def encoded_contrasts(phones1, phones2):
+    """
+    Dictionary-encoded contrast names for two columns of phones sharing the
+    same (sorted) vocabulary. Contrast names are only built once for each
+    distinct pair of phones.
+    """
+    phones = np.asarray(phones1.cat.categories, dtype=object)
+    codes1 = phones1.cat.codes.values.astype(np.int64)
+    codes2 = phones2.cat.codes.values.astype(np.int64)
+    # since the vocabulary is sorted, comparing codes is the same as
+    # comparing phones
+    pair_codes = np.minimum(codes1, codes2)*len(phones) + \
+                    np.maximum(codes1, codes2)
+    pair_codes, pairs = pandas.factorize(pair_codes)
+    names = np.array([mp_contrast_name(phones[pair // len(phones)],
+                                       phones[pair % len(phones)])
+                      for pair in pairs], dtype=object)
+    vocab, name_codes = np.unique(names, return_inverse=True)
+    return pandas.Categorical.from_codes(name_codes[pair_codes], vocab)
+
+
+def mean_scores(df, cols):
+    """
+    Average scores over groups defined by cols, in double precision,
+    and return them in compact format.
+    """
+    groups = df['score'].astype(np.float64).groupby(group_keys(df, cols))
+    scores = groups.mean().astype(SCORE_DTYPE)
+    return restore_encoding(scores.reset_index(), df, cols)
+
+
 @load_cfg_from_file
 def drop_asymetric_scores(df, reg_cols, cfg=None):
     l = len(df)
     df = add_contrast_col(df, cfg['phone_1'], cfg['phone_2'])
-    groups = df.groupby(['contrast'] + reg_cols, as_index=False)
-    df = groups.filter(lambda x: len(x) == 2)
+    keys = group_keys(df, ['contrast'] + reg_cols)
+    sizes = df['score'].groupby(keys).transform('size')
+    df = df[sizes.values == 2]
     if len(df) != l:
         dl = l-len(df)
         print('{} scores had no matching symetric, they were dropped'.format(dl))
@@ -89,13 +241,169 @@ def drop_asymetric_scores(df, reg_cols, cfg=None):
 
 @load_cfg_from_file
 def symetrize_scores(df, reg_cols, cfg=None):
+    """
+    Average the two scores obtained for each (contrast, speaker, context) key,
+    i.e. for the two possible orders of the phones in the contrast.
+    Scores without a matching symetric are dropped (their number is printed),
+    so there is no need to call drop_asymetric_scores beforehand.
+    Group sizes and sums are computed in a single vectorized pass.
+    """
+    df = add_contrast_col(df, cfg['phone_1'], cfg['phone_2'])
+    cols = ['contrast'] + reg_cols
+    sums = grouped_score_sums(df, cols)
+    return symetrize_score_sums(sums.set_index(cols), cfg=cfg)
+
+
+def grouped_score_sums(df, cols):
+    """
+    Sum, number of non-NaN scores and number of scores for each group
+    of rows of df defined by cols.
+    """
+    groups = df['score'].astype(np.float64).groupby(group_keys(df, cols))
+    sums = groups.agg(['sum', 'count', 'size']).reset_index()
+    return restore_encoding(sums, df, cols)
+
+
+@load_cfg_from_file
+def symetrize_score_sums(sums, cfg=None):
+    """
+    Get symetrized scores from (contrast, speaker, context)-indexed score sums
+    (see grouped_score_sums), dropping keys for which there isn't exactly one
+    score in each direction.
+    """
+    matched = sums['size'] == 2
+    if not(matched.all()):
+        dl = sums['size'][~matched].sum()
+        print('{} scores had no matching symetric, they were dropped'.format(dl))
+    sums = sums[matched]
+    scores = sums['sum'] / sums['count']
+    scores.name = 'score'
+    return encode(scores.reset_index(), cfg=cfg)
+
+
+# Streaming version of the above, for results files that do not fit in memory:
+# we only keep running sums and counts of scores for each
+# (contrast, speaker, context) key.
+
+@load_cfg_from_file
+def score_sums(df, reg_cols, cfg=None):
+    """
+    Sum, number of non-NaN scores and number of scores for each
+    (contrast, speaker, context) key in df.
+    """
     df = add_contrast_col(df, cfg['phone_1'], cfg['phone_2'])
-    groups = df.groupby(['contrast'] + reg_cols, as_index=False)
-    # check that all results can be symetrized
-    # this should be guaranteed since we use drop_asymetric_scores above
-    wrong_lengths = {(g, df_g) for g, df_g in groups if len(df_g) != 2}   
-    assert not(wrong_lengths), wrong_lengths
-    return groups['score'].mean()
+    cols = ['contrast'] + reg_cols
+    sums = grouped_score_sums(df, cols)
+    # vocabularies can differ between chunks, so the keys are decoded
+    return decode(sums).set_index(cols)
+
+
+def merge_score_sums(sums_list):
+    # all sums are indexed by the same (contrast, speaker, context) keys
+    sums = pandas.concat(sums_list)
+    return sums.groupby(level=list(range(sums.index.nlevels))).sum()
+
+
+@load_cfg_from_file
+def stream_symetrized_scores(result_file, reg_cols, chunksize, cfg=None):
+    """
+    Load, drop asymetric scores and symetrize scores from an ABXpy results
+    file, reading chunksize lines at a time. Peak memory usage is bounded by
+    the number of (contrast, speaker, context) keys rather than by
+    the number of lines in the file.
+    """
+    sums = None
+    for df in load_df_chunks(result_file, reg_cols, chunksize, cfg=cfg):
+        chunk_sums = score_sums(df, reg_cols, cfg=cfg)
+        if sums is None:
+            sums = chunk_sums
+        else:
+            sums = merge_score_sums([sums, chunk_sums])
+    return symetrize_score_sums(sums, cfg=cfg)
+
+
+# Sharded version, to use several processes on a single big results file.
+# In a within speaker task, all the scores that are averaged together during
+# symetrization come from the same speaker, so the results file can be split
+# by speaker and the shards symetrized in parallel. The symetrized shards are
+# then merged back in the same row order as in the serial path, so that
+# subsequent aggregations give bit-identical results (floating-point sums
+# over speakers computed separately in each shard could not be merged
+# without changing the rounding of the results).
+
+def symetrize_shard(task):
+    # module-level function so that it can be used in a process pool
+    df, reg_cols, cfg = task
+    return symetrize_scores(df, reg_cols, cfg=cfg)
+
+
+@load_cfg_from_file
+def sharded_symetrize_scores(df, reg_cols, spk_shards, cfg=None):
+    """
+    Same as symetrize_scores, using a pool of spk_shards processes,
+    each symetrizing the scores of a different subset of speakers.
+    """
+    df = add_contrast_col(df, cfg['phone_1'], cfg['phone_2'])
+    cols = ['contrast'] + reg_cols
+    spk_codes = group_keys(df, [cfg['speaker']])[0].values
+    spks = np.unique(spk_codes)
+    n_shards = min(spk_shards, len(spks))
+    # contiguous blocks of speakers of approximately equal size
+    shard_ids = np.searchsorted(spks, spk_codes) * n_shards // len(spks)
+    tasks = [(df.loc[shard_ids == i, cols + ['score']], reg_cols, cfg)
+             for i in range(n_shards)]
+    pool = multiprocessing.Pool(len(tasks))
+    try:
+        shards = pool.map(symetrize_shard, tasks)
+    finally:
+        pool.close()
+        pool.join()
+    # shards share the same vocabularies, so the concatenation stays encoded
+    df = pandas.concat(shards, ignore_index=True)
+    # get back to the row order of symetrize_scores output
+    codes = [key.values for key in group_keys(df, cols)]
+    order = np.lexsort(codes[::-1])
+    return df.take(order).reset_index(drop=True)
+
+
+@load_cfg_from_file
+def symetrized_scores(result_file, reg_cols, chunksize=None, cache_dir=None,
+                      spk_shards=None, fingerprint=None, cfg=None):
+    """
+    Symetrized scores for an ABXpy results file. If chunksize is not None,
+    the file is streamed (see stream_symetrized_scores). If spk_shards is not
+    None, the scores are symetrized in parallel by subsets of speakers (see
+    sharded_symetrize_scores).
+    If cache_dir is not None, the symetrized scores are cached in that folder
+    and the results file is only parsed if no cache entry matching its
+    content is found (see results_cache.py). The fingerprint of the results
+    file can be passed if it is already known, to avoid hashing it again.
+    """
+    if not(chunksize is None) and not(spk_shards is None):
+        raise ValueError("Streaming and sharding by speakers cannot be"
+                         " used together")
+    def compute():
+        if chunksize is None:
+            df = load_df(result_file, reg_cols, cfg=cfg)
+            if spk_shards is None:
+                df = symetrize_scores(df, reg_cols, cfg=cfg)
+            else:
+                df = sharded_symetrize_scores(df, reg_cols, spk_shards,
+                                              cfg=cfg)
+        else:
+            df = stream_symetrized_scores(result_file, reg_cols, chunksize,
+                                          cfg=cfg)
+        return df
+    if cache_dir is None:
+        df = compute()
+    else:
+        if fingerprint is None:
+            fingerprint = results_cache.file_fingerprint(result_file)
+        key = results_cache.cache_key(fingerprint,
+                                      'symetrized', cfg['phone_1'],
+                                      cfg['phone_2'], reg_cols)
+        df = results_cache.cached(cache_dir, key, compute)
+    return df
 
 
 #################################
@@ -107,8 +415,7 @@ def ordered_aggregation(df, *agg_cols_list):
     # utility function to do structured averaging of scores
     for agg_cols in agg_cols_list:
         cols = ['contrast'] + agg_cols
-        groups = df.groupby(cols, as_index=False)
-        df = groups['score'].mean()
+        df = mean_scores(df, cols)
     return df
 
 
@@ -155,6 +462,39 @@ def minimal_pair_scores_by_spk(df, cfg=None):
     return df
 
 
+MP_TYPES = ['spk_first', 'context_first', 'by_spk', 'by_context']
+
+
+@load_cfg_from_file
+def minimal_pair_scores(df, mp_types, cfg=None):
+    """
+    Compute several types of minimal-pair scores from the same symetrized
+    scores at once. Returns a dict with an entry for each mp_type in mp_types.
+    
+    The aggregations on speakers (resp. contexts) are computed only once and
+    shared between 'by_context' and 'spk_first' (resp. 'by_spk' and
+    'context_first') scores, which are respectively obtained by averaging
+    them over contexts (resp. speakers).
+    """
+    for mp_type in mp_types:
+        if not(mp_type in MP_TYPES):
+            raise ValueError("Unsupported mp type {}".format(mp_type))
+    res = {}
+    if 'by_context' in mp_types or 'spk_first' in mp_types:
+        by_context = minimal_pair_scores_by_context(df, cfg=cfg)
+        if 'by_context' in mp_types:
+            res['by_context'] = by_context
+        if 'spk_first' in mp_types:
+            res['spk_first'] = ordered_aggregation(by_context, [])
+    if 'by_spk' in mp_types or 'context_first' in mp_types:
+        by_spk = minimal_pair_scores_by_spk(df, cfg=cfg)
+        if 'by_spk' in mp_types:
+            res['by_spk'] = by_spk
+        if 'context_first' in mp_types:
+            res['context_first'] = ordered_aggregation(by_spk, [])
+    return res
+
+
 ######################
 # Querying mp scores #
 ######################
@@ -184,24 +524,24 @@ def get_mp_error(df, phone_1, phone_2):
 
 
 @load_cfg_from_file
-def get_mp_con_error(df, phone_1, phone_2, prev_con, next_con):
+def get_mp_con_error(df, phone_1, phone_2, prev_con, next_con, cfg=None):
     """Function to query a particular minimal-pair ABX error (in %)"""
     contrast = mp_contrast_name(phone_1, phone_2)
     ix = np.where((df['contrast'] == contrast) & (df[cfg['prev-phone']] == prev_con) & (df[cfg['next-phone']] == next_con))[0]
     if ix.size == 0:
-        print("No entry available for minimal-pair {} in context {}".format(contrast, "-".join(prev_con, next_con)))
+        print("No entry available for minimal-pair {} in context {}".format(contrast, "-".join([prev_con, next_con])))
         error = np.nan
     else:
         line = df.iloc[ix]
         error = line['error']
         assert(len(error) <= 1), ("More than one entry "
-                                  "for minimal-pair {} in context {}").format(contrast, "-".join(prev_con, next_con))                        
+                                  "for minimal-pair {} in context {}").format(contrast, "-".join([prev_con, next_con]))                        
         error = error.iloc[0]
     return error
 
 
 @load_cfg_from_file
-def get_mp_spk_error(df, phone_1, phone_2, spk):
+def get_mp_spk_error(df, phone_1, phone_2, spk, cfg=None):
     """Function to query a particular minimal-pair ABX error (in %)"""
     contrast = mp_contrast_name(phone_1, phone_2)
     ix = np.where((df['contrast'] == contrast) & (df[cfg['speaker']] == spk))[0]
@@ -212,68 +552,389 @@ def get_mp_spk_error(df, phone_1, phone_2, spk):
         line = df.iloc[ix]
         error = line['error']
         assert(len(error) <= 1), ("More than one entry "
-                                  "for minimal-pair {} for speaker {}").format(contrast, con)                        
+                                  "for minimal-pair {} for speaker {}").format(contrast, spk)                        
         error = error.iloc[0]
     return error
 
 
+# The get_mp_*error functions above scan the whole DataFrame for each query.
+# To make many queries, build an index once instead, for example:
+#   index = mp_con_error_index(df)
+#   error = index.get('R', 'L', 'AA', 'IY')
+#   errors = index.lookup(phones_1, phones_2, prev_phones, next_phones)
+
+class MPErrorIndex(object):
+    """
+    Index of the minimal-pair errors (in %) in a DataFrame, keyed on
+    contrast and optionally on other columns (e.g. contexts or speaker).
+    Lookups of missing entries return NaN.
+    """
+
+    def __init__(self, df, by=None, value_col='error'):
+        if by is None:
+            by = []
+        self.by = by
+        keys = [np.asarray(df[col], dtype=object)
+                for col in ['contrast'] + by]
+        self.index = pandas.MultiIndex.from_arrays(keys)
+        if not(self.index.is_unique):
+            duplicated = self.index[self.index.duplicated()][0]
+            raise ValueError(("More than one entry for {} {}"
+                              ).format(['contrast'] + by, duplicated))
+        self.positions = {key: i for i, key in enumerate(self.index)}
+        self.values = np.asarray(df[value_col], dtype=np.float64)
+
+    def get(self, phone_1, phone_2, *by_values):
+        """Error for a single minimal-pair (and values of the by columns)"""
+        key = (mp_contrast_name(phone_1, phone_2),) + by_values
+        i = self.positions.get(key)
+        return np.nan if i is None else self.values[i]
+
+    def lookup(self, phones_1, phones_2, *by_values):
+        """
+        Errors for arrays of minimal-pairs (and values of the by columns),
+        scalars being broadcast.
+        """
+        phones_1, phones_2 = np.broadcast_arrays(np.asarray(phones_1,
+                                                            dtype=object),
+                                                 np.asarray(phones_2,
+                                                            dtype=object))
+        contrasts = [mp_contrast_name(p1, p2)
+                     for p1, p2 in zip(phones_1.ravel(), phones_2.ravel())]
+        return self.lookup_contrasts(np.array(contrasts, dtype=object
+                                              ).reshape(phones_1.shape),
+                                     *by_values)
+
+    def lookup_contrasts(self, contrasts, *by_values):
+        """Same as lookup, for contrast names"""
+        keys = np.broadcast_arrays(*[np.asarray(e, dtype=object)
+                                     for e in (contrasts,) + by_values])
+        query = pandas.MultiIndex.from_arrays([key.ravel() for key in keys])
+        ix = self.index.get_indexer(query)
+        # misses (-1) are masked, clip only avoids indexing empty values
+        errors = np.take(self.values, ix, mode='clip') if len(self.values) \
+                    else np.zeros(len(ix))
+        errors = np.where(ix >= 0, errors, np.nan)
+        return errors.reshape(keys[0].shape)
+
+
+def mp_error_index(df):
+    """Index for get_mp_error queries"""
+    return MPErrorIndex(df)
+
+
+@load_cfg_from_file
+def mp_con_error_index(df, cfg=None):
+    """Index for get_mp_con_error queries"""
+    return MPErrorIndex(df, by=[cfg['prev-phone'], cfg['next-phone']])
+
+
+@load_cfg_from_file
+def mp_spk_error_index(df, cfg=None):
+    """Index for get_mp_spk_error queries"""
+    return MPErrorIndex(df, by=[cfg['speaker']])
+
+
 #####################################
 # Precomputing and saving mp scores #
 #####################################
 
+def mp_type_folders(out_folder, mp_types):
+    """
+    Folders where precompute_mp_scores stores each type of mp scores: directly
+    in out_folder if there is a single type of mp scores and in a subfolder of
+    out_folder named after the mp type otherwise.
+    """
+    if len(mp_types) == 1:
+        folders = {mp_types[0]: out_folder}
+    else:
+        folders = {mp_type: path.join(out_folder, mp_type)
+                    for mp_type in mp_types}
+    return folders
+
+
+# The manifest of an output folder records, for each mp scores file, the
+# fingerprint of the results file it was computed from, the results file
+# columns in the config and the mp type, so that precompute_mp_scores can
+# recompute only the outputs that are missing or out-of-date.
+
+MANIFEST_FILE = 'manifest.json'
+
+
+def load_manifest(out_folder):
+    # dict: output path relative to out_folder -> manifest entry
+    manifest_file = path.join(out_folder, MANIFEST_FILE)
+    if path.exists(manifest_file):
+        with open(manifest_file, 'r') as fh:
+            manifest = json.load(fh)
+    else:
+        manifest = {}
+    return manifest
+
+
+def save_manifest(manifest, out_folder):
+    content = json.dumps(manifest, indent=2, sort_keys=True).encode('utf-8')
+    results_cache.atomic_save(path.join(out_folder, MANIFEST_FILE),
+                              lambda fh: fh.write(content))
+
+
+def source_fingerprint(result_file, entries):
+    """
+    Fingerprint of result_file. To avoid hashing big results files on each
+    run, the fingerprint recorded in one of the manifest entries for
+    result_file is reused if the size and modification time of the file
+    did not change since then.
+    """
+    stat = os.stat(result_file)
+    for entry in entries:
+        if not(entry is None) and entry['size'] == stat.st_size and \
+                entry['mtime'] == stat.st_mtime:
+            return entry['fingerprint']
+    return results_cache.file_fingerprint(result_file)
+
+
+def manifest_entry(result_file, fingerprint, mp_type, cfg):
+    stat = os.stat(result_file)
+    return {'source': path.basename(result_file),
+            'fingerprint': fingerprint,
+            'size': stat.st_size,
+            'mtime': stat.st_mtime,
+            # ordered, as the column layout of the output follows cfg
+            'columns': [[key, value] for key, value in cfg.items()],
+            'mp_type': mp_type}
+
+
+def is_up_to_date(res_file, entry, expected):
+    # outputs that are not in the manifest are considered stale
+    if entry is None or not(path.exists(res_file)):
+        return False
+    keys = ['source', 'fingerprint', 'columns', 'mp_type']
+    return all([entry[key] == expected[key] for key in keys])
+
+
+def precompute_file_mp_scores(task):
+    """
+    Compute and save the mp scores for a single results file.
+    task is a (result_file, res_files, reg_cols, chunksize, cache_dir,
+    spk_shards, fingerprint, cfg) tuple, where res_files is a dict giving
+    the output file for each mp type.
+    Returns the name of the results file and None if everything went well,
+    or a description of the error otherwise.
+    This is a module-level function so that it can be used in a process pool.
+    """
+    (result_file, res_files, reg_cols, chunksize, cache_dir, spk_shards,
+     fingerprint, cfg) = task
+    try:
+        df = symetrized_scores(result_file, reg_cols, chunksize=chunksize,
+                               cache_dir=cache_dir, spk_shards=spk_shards,
+                               fingerprint=fingerprint, cfg=cfg)
+        dfs = minimal_pair_scores(df, list(res_files), cfg=cfg)
+        for mp_type, res_file in res_files.items():
+            # write to a temporary file first so that partially written
+            # pickles never appear in the output folder
+            results_cache.atomic_save(res_file,
+                                      lambda fh, df=dfs[mp_type]: pickle.dump(df, fh))
+        error = None
+    except Exception:
+        error = traceback.format_exc()
+    return result_file, error
+
+
 @load_cfg_from_file
-def precompute_mp_scores(in_folder, out_folder, mp_type='spk_first', filt=None, cfg=None):
+def precompute_mp_scores(in_folder, out_folder, mp_type='spk_first', filt=None,
+                         chunksize=None, cache_dir=None, overwrite=False,
+                         jobs=1, spk_shards=None, cfg=None):
     """
     Function to precompute minimal-pair scores for all results file in a folder    
         in_folder : str, folder containing results files from ABXpy.analyze
         out_folder : str, folder where to put pickles containing the mp scores
-        mp_type : specify how to compute minimal-pair scores
+        mp_type : specify how to compute minimal-pair scores, can also be
+                a list of mp types, in which case results files are
+                symetrized only once and each type of mp scores is stored
+                in its own subfolder of out_folder (see mp_type_folders)
         filt : (str -> bool) function, takes an ABXpy results filename 
                 without the extension and decides whether to extract mp scores
                 for that file based on the name
+        chunksize : int, if specified, results files are read chunksize lines
+                at a time, with memory usage bounded by the number of
+                (contrast, speaker, context) keys instead of the number
+                of lines in the files
+        cache_dir : str, if specified, folder where to cache parsed and
+                symetrized results files for quick re-use (e.g. by
+                resample_mp_scores.py)
+        overwrite : bool, whether to recompute all mp scores files, or
+                only those which are missing or out-of-date according to
+                the manifest of out_folder (see MANIFEST_FILE)
+        jobs : int, number of results files to process in parallel
+                (in a pool of jobs processes)
+        spk_shards : int, if specified, each results file is split by
+                speakers into spk_shards parts symetrized in parallel. This is
+                useful when a single big file dominates the computation time.
+                Results are bit-identical to those obtained without sharding.
+                Can't be used together with jobs > 1.
+    Files for which the computation fails are reported and skipped, an error
+    listing them is raised once all other files have been processed.
     """
-    if mp_type == 'spk_first':
-        minimal_pair_scores = minimal_pair_scores_spk_first
-    elif mp_type == 'context_first':
-        minimal_pair_scores = minimal_pair_scores_context_first
-    elif mp_type == 'by_spk':
-        minimal_pair_scores = minimal_pair_scores_by_spk
-    elif mp_type == 'by_context':
-        minimal_pair_scores = minimal_pair_scores_by_context
+    if jobs > 1 and not(spk_shards is None):
+        raise ValueError("Results files can be processed in parallel or"
+                         " sharded by speakers, but not both")
+    if isinstance(mp_type, str):
+        mp_types = [mp_type]
     else:
-        raise ValueError("Unsupported mp type {}".format(mp_type))
+        mp_types = list(mp_type)
+    for e in mp_types:
+        if not(e in MP_TYPES):
+            raise ValueError("Unsupported mp type {}".format(e))
+    out_folders = mp_type_folders(out_folder, mp_types)
+    for folder in out_folders.values():
+        if not(path.exists(folder)):
+            os.makedirs(folder)
     if filt is None:
         filt = lambda x: True
     reg_cols = list(cfg.values())[2:]  # this relies on cfg being **ordered**
-    for f in os.listdir(in_folder):
+    manifest = load_manifest(out_folder)
+    tasks, new_entries = [], {}
+    nb_up_to_date = 0
+    manifest_changed = False
+    for f in sorted(os.listdir(in_folder)):
         model, ext = path.splitext(f)
         if ext == '.txt' and filt(model):
-            res_file = path.join(out_folder, model+'.pickle')
-            if path.exists(res_file):
-                raise IOError(("Minimal pair file "
-                               "already exists: {}").format(res_file))
-            df = load_df(path.join(in_folder, f), reg_cols)
-            df = drop_asymetric_scores(df, reg_cols)
-            df = symetrize_scores(df, reg_cols)
-            df = minimal_pair_scores(df)
-            with open(res_file, 'wb') as fh:
-                pickle.dump(df, fh)
+            result_file = path.join(in_folder, f)
+            res_files = {e: path.join(out_folders[e], model+'.pickle')
+                            for e in mp_types}
+            keys = {e: path.relpath(res_files[e], out_folder)
+                        for e in mp_types}
+            fingerprint = source_fingerprint(result_file,
+                                             [manifest.get(keys[e])
+                                                for e in mp_types])
+            entries = {e: manifest_entry(result_file, fingerprint, e, cfg)
+                        for e in mp_types}
+            stale = [e for e in mp_types
+                        if overwrite or not(is_up_to_date(res_files[e],
+                                                          manifest.get(keys[e]),
+                                                          entries[e]))]
+            if stale:
+                tasks.append((result_file, {e: res_files[e] for e in stale},
+                              reg_cols, chunksize, cache_dir, spk_shards,
+                              fingerprint, cfg))
+                new_entries[result_file] = {keys[e]: entries[e] for e in stale}
+            else:
+                nb_up_to_date = nb_up_to_date+1
+            # refresh size and modification time of up-to-date entries
+            # (e.g. for touched files) to avoid hashing them again next time
+            for e in mp_types:
+                if not(e in stale) and manifest[keys[e]] != entries[e]:
+                    manifest[keys[e]] = entries[e]
+                    manifest_changed = True
+    if manifest_changed:
+        save_manifest(manifest, out_folder)
+    if nb_up_to_date:
+        print(("mp scores for {} results files are up-to-date and will not be"
+               " computed again").format(nb_up_to_date))
+    if jobs > 1:
+        pool = multiprocessing.Pool(jobs)
+        results = pool.imap_unordered(precompute_file_mp_scores, tasks)
+    else:
+        pool = None
+        results = map(precompute_file_mp_scores, tasks)
+    failed = []
+    for i, (result_file, error) in enumerate(results):
+        if error is None:
+            # the manifest is updated as soon as each file is done, so that
+            # the work done is not lost if the computation is interrupted
+            manifest.update(new_entries[result_file])
+            save_manifest(manifest, out_folder)
+            print("[{}/{}] Computed mp scores for {}".format(i+1, len(tasks),
+                                                             result_file))
+        else:
+            print("[{}/{}] Failed to compute mp scores for {}:\n{}".format(
+                                            i+1, len(tasks), result_file, error))
+            failed.append(result_file)
+    if not(pool is None):
+        pool.close()
+        pool.join()
+    if failed:
+        raise RuntimeError(("Failed to compute mp scores for {} results files:"
+                            " {}").format(len(failed), ', '.join(failed)))
 
 
 ###########################
 # Loading saved mp scores #
 ###########################
+# The mp scores of all files are concatenated column by column, with a
+# single copy of each array, instead of through pandas.concat: the loaded
+# DataFrames (possibly kept in boot_df for later use) are left untouched and
+# metadata columns are built as pandas.Categorical columns (one small integer
+# per row) rather than as Python string columns.
+
+def concat_columns(cols):
+    """
+    Concatenate a column from several DataFrames, dictionary-encoded columns
+    being decoded to plain strings
+    """
+    if any([is_encoded(col) or col.dtype == object for col in cols]):
+        vocab = vocabulary(cols)
+        codes = np.concatenate([pandas.Categorical(col, categories=vocab).codes
+                                for col in cols])
+        return vocab[codes]
+    return np.concatenate([np.asarray(col) for col in cols])
+
+
+def metadata_columns(metadata, lengths):
+    """
+    Categorical columns containing for each file the values in its
+    metadata (a list of key, value pairs), repeated lengths times
+    """
+    cols = {}
+    for j, (name, _) in enumerate(metadata[0]):
+        values = [file_metadata[j][1] for file_metadata in metadata]
+        assert all([file_metadata[j][0] == name
+                    for file_metadata in metadata]), \
+            "All files should have the same metadata"
+        codes, categories = pandas.factorize(np.asarray(values, dtype=object),
+                                             sort=True)
+        cols[name] = pandas.Categorical.from_codes(np.repeat(codes, lengths),
+                                                   categories)
+    return cols
+
+
+def concat_mp_errors(dfs, metadata, extra_cols=None):
+    """
+    DataFrame containing the rows of all mp scores DataFrames in dfs,
+    followed by the metadata of the corresponding file and by scores
+    converted to error rates in % ('error' column), then by the columns in
+    extra_cols (a list of name, list of arrays pairs, aligned with dfs).
+    """
+    assert dfs, "No minimal-pair scores found"
+    if extra_cols is None:
+        extra_cols = []
+    cols = [col for col in dfs[0].columns if col != 'score']
+    assert all([set(df.columns) == set(cols + ['score']) for df in dfs]), \
+        "All mp scores should have the same columns"
+    res = pandas.DataFrame({col: concat_columns([df[col] for df in dfs])
+                            for col in cols}, columns=cols)
+    lengths = [len(df) for df in dfs]
+    for name, col in metadata_columns(metadata, lengths).items():
+        res[name] = col
+    # convert scores to error rates in %
+    scores = np.concatenate([np.asarray(df['score']) for df in dfs])
+    res['error'] = 100*(1-scores.astype(np.float64))
+    for name, arrays in extra_cols:
+        res[name] = np.concatenate(arrays)
+    return res
+
 
 def load_mp_errors(folder, get_metadata,
                    filt=None, encoding=None, boot_batch_ind=None,
-                   boot_df=None, return_raw_df=False):
+                   boot_df=None, return_raw_df=False, files=None):
     """
     Load and concatenate together minimal-pair error dataframes from a folder
     containing pickled versions of these dataframes.
     
     The get_metadata function takes the results-file path as input and returns
     a list of key, value pairs describing the content of that file (metadata).
-    This metadata is then added to the output dataframe.
+    This metadata is then added to the output dataframe (as categorical
+    columns).
     The same kind of metadata should be provided for all files considered.
     
     If not all dataframes are needed, the 'filt' argument can be used to select
@@ -286,25 +947,39 @@ def load_mp_errors(folder, get_metadata,
     If the pickled data correspond to whole batches of resampled data a
     specific resample can be selected by specifying 'boot_batch_ind'
     (between 0 and 49 included for batches of size 50). To select only specific
-    batches, use 'filt' appropriately.  
+    batches, use 'filt' appropriately. Batches of resampled data can also be
+    stored in .npz files (see resample_store.py), which are used instead of
+    pickles with the same name if both are present.
     
     boot_df can be used to avoid re-loading again and again the same data
     when resamples for several batches are stored together. It is the caller's
     responsibility to make sure boot_df contains the right data.
 
     return_raw_df can be used to get the raw data (useful in conjunction with
-    boot_df)
+    boot_df). The raw data is not modified.
+
+    files can be used to specify the names of the files in folder to consider
+    instead of listing the folder (e.g. from a catalog, see catalog.py).
     """
     if filt is None:
         filt = lambda x: True
     dfs = []
+    metadata = []
     if return_raw_df:
         df_raws = {}
-    for f in os.listdir(folder):
+    if files is None:
+        files = os.listdir(folder)
+    for f in files:
         model, ext = path.splitext(f)
-        if ext == '.pickle' and filt(model):
+        if not(boot_batch_ind is None) and ext == '.pickle' and \
+                model + '.npz' in files:
+            continue
+        is_store = not(boot_batch_ind is None) and ext == '.npz'
+        if (ext == '.pickle' or is_store) and filt(model):
             if not(boot_df is None):
                     df_raw = boot_df[model]
+            elif is_store:
+                df_raw = resample_store.load_resamples(path.join(folder, f))
             else:
                 with open(path.join(folder, f), 'rb') as fh:
                     if encoding is None:
@@ -312,21 +987,20 @@ def load_mp_errors(folder, get_metadata,
                     else:
                         # allow hacks to handle pickles saved from python2
                         df_raw = pickle.load(fh, encoding=encoding)
-            if not(boot_batch_ind is None):
+            if is_store:
+                df_model = resample_store.resample_df(df_raw, boot_batch_ind)
+            elif not(boot_batch_ind is None):
                  # if bootstrap resample select desired resample only
                 df_model = df_raw[boot_batch_ind]
             else:
                 df_model = df_raw
-            metadata = get_metadata(path.join(folder, f))
-            for name, value in metadata:
-                df_model[name] = value
             dfs.append(df_model)
+            metadata.append(get_metadata(path.join(folder, f)))
             if return_raw_df:
                 df_raws[model] = df_raw
-    df = pandas.concat(dfs)
-    # convert scores to error rates in %
-    df['error'] = 100*(1-df['score'])
-    del df['score']
+    # this is where we leave the encoded representation used for computing
+    # mp scores
+    df = concat_mp_errors(dfs, metadata)
     if return_raw_df:
         return df, df_raws
     else:
@@ -355,37 +1029,190 @@ def resample(items, nb_resamples):
     return resamples
 
 
+def replicate_rng(seed, replicate):
+    """
+    Random generator for a given bootstrap replicate.
+    Each replicate gets its own independent stream, spawned from the root
+    seed and indexed by the (global) index of the replicate, so that
+    a replicate does not depend on how replicates are split between jobs,
+    batches or processes.
+    """
+    seq = np.random.SeedSequence(seed, spawn_key=(replicate,))
+    return np.random.Generator(np.random.PCG64(seq))
+
+
+def resample_with_seed(items, replicates, seed):
+    """
+    Same as resample, for the given replicate indices, using
+    per-replicate random streams.
+    """
+    resamples = [replicate_rng(seed, i).choice(items, len(items))
+                 for i in replicates]
+    return np.row_stack(resamples)
+
+
+# Per-speaker statistics used by the workers of the process pool in
+# resample_mp_score_within_speakers. They are passed once to each worker
+# when it starts, instead of once per task.
+_bootstrap_statistics = None
+
+
+def set_bootstrap_statistics(statistics):
+    global _bootstrap_statistics
+    _bootstrap_statistics = statistics
+
+
+def bootstrap_task(task):
+    # module-level function so that it can be used in a process pool
+    replicates, seed = task
+    values, mask, key_contrasts = _bootstrap_statistics
+    n_spk = values.shape[0]
+    spk_resamples = resample_with_seed(np.arange(n_spk), replicates, seed)
+    spk_counts = np.row_stack([np.bincount(spk_resample, minlength=n_spk)
+                               for spk_resample in spk_resamples])
+    scores, _ = bootstrap_spk_first(values, mask, key_contrasts, spk_counts)
+    return scores
+
+
+@load_cfg_from_file
+def speaker_statistics(df, cfg=None):
+    """
+    Per-speaker statistics of symetrized scores sufficient to compute
+    'spk_first' minimal-pair scores for any resample of the speakers.
+    Returns:
+        values : (speakers, keys) float64 array, symetrized score of each
+                speaker for each (contrast, previous phone, next phone) key
+                (0 where the speaker has no score for the key)
+        mask : (speakers, keys) float64 array, 1 where the speaker has a
+                (non-NaN) score for the key and 0 otherwise
+        key_contrasts : contrast code of each key
+    Keys are sorted by codes, so that keys for the same contrast are
+    contiguous and in the order of minimal_pair_scores_spk_first outputs.
+    """
+    key_cols = ['contrast', cfg['prev-phone'], cfg['next-phone']]
+    spk_codes = group_keys(df, [cfg['speaker']])[0].values
+    _, spk_ix = np.unique(spk_codes, return_inverse=True)
+    key_ix = df.groupby(group_keys(df, key_cols)).ngroup().values
+    n_spk, n_keys = spk_ix.max()+1, key_ix.max()+1
+    values = np.zeros((n_spk, n_keys))
+    mask = np.zeros((n_spk, n_keys))
+    # symetrized scores are unique for each (speaker, key), missing scores
+    # are left out as in the averages of minimal_pair_scores_spk_first
+    scores = df['score'].values.astype(np.float64)
+    values[spk_ix, key_ix] = np.nan_to_num(scores)
+    mask[spk_ix, key_ix] = ~np.isnan(scores)
+    key_contrasts = np.zeros(n_keys, dtype=np.int64)
+    key_contrasts[key_ix] = group_keys(df, ['contrast'])[0].values
+    return values, mask, key_contrasts
+
+
+def bootstrap_spk_first(values, mask, key_contrasts, spk_counts):
+    """
+    'spk_first' minimal-pair scores for a batch of resamples of the
+    speakers, given as a (resamples, speakers) array of the number of times
+    each speaker was drawn (see speaker_statistics for other arguments).
+    Since averaging over speakers comes first, each resample only
+    reweights the per-speaker scores, so that it boils down to matrix
+    products. Returns a (resamples, contrasts) float32 array of scores
+    (NaN for contrasts without any score in a resample) and the
+    corresponding contrast codes.
+    """
+    spk_counts = spk_counts.astype(np.float64)
+    sums = spk_counts @ values
+    counts = spk_counts @ mask
+    observed = counts > 0
+    with np.errstate(invalid='ignore', divide='ignore'):
+        # scores averaged over speakers are stored in SCORE_DTYPE
+        # as in mean_scores
+        context_scores = (sums / counts).astype(SCORE_DTYPE)
+    context_scores = np.where(observed, context_scores, 0).astype(np.float64)
+    # keys for a given contrast are contiguous
+    contrasts, starts = np.unique(key_contrasts, return_index=True)
+    contrast_sums = np.add.reduceat(context_scores, starts, axis=1)
+    contrast_counts = np.add.reduceat(observed.astype(np.float64), starts,
+                                      axis=1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        scores = (contrast_sums / contrast_counts).astype(SCORE_DTYPE)
+    return scores, contrasts
+
+
 @load_cfg_from_file
-def resample_mp_score_within_speakers(df, nb_resamples, reg_cols, mp_type='spk_first', cfg=None):
+def resample_mp_score_within_speakers(df, nb_resamples, reg_cols, mp_type='spk_first',
+                                      symetrized=False, block_size=100,
+                                      seed=None, first_replicate=0, jobs=1,
+                                      cfg=None):
     """
     Resample minimal-pair scores obtained
     in a within speaker task over speakers.
+    If symetrized is True, df is assumed to contain already symetrized scores
+    (e.g. as returned by symetrized_scores) instead of raw scores.
+    Per-speaker statistics are computed once and resamples are then obtained
+    block_size at a time with matrix products (see bootstrap_spk_first).
+    Speakers are drawn exactly as in a naive implementation concatenating
+    the data of the drawn speakers for each resample, and the results are
+    the same up to floating-point rounding.
+    If seed is None, speakers are drawn from the global numpy random
+    generator. Otherwise, replicates first_replicate to
+    first_replicate+nb_resamples-1 are computed, each with its own random
+    stream derived from seed (see replicate_rng): a given replicate is then
+    the same whichever way the replicates are split between calls, and
+    blocks of replicates can be computed in parallel in a pool of jobs
+    processes.
     """
     if mp_type != 'spk_first':
         raise ValueError("Resampling over speaker only supported for minimal pairs"
                          "averaged on spk and context, in that order.")
-    speaker_col = cfg['speaker']
-    spk_resamples = resample(np.unique(df[speaker_col]), nb_resamples)     
-    spk_groups = df.groupby(speaker_col, as_index=False)
-    spk_id, spk_data = list(zip(*spk_groups))  # list of pairs to pair of lists
+    if not(symetrized):
+        df = symetrize_scores(df, reg_cols, cfg=cfg)
+    if seed is None and jobs > 1:
+        raise ValueError("A seed is required to resample in parallel")
+    statistics = speaker_statistics(df, cfg=cfg)
+    values, mask, key_contrasts = statistics
+    n_spk = values.shape[0]
+    contrasts = np.unique(key_contrasts)
+    categories = df['contrast'].cat.categories
+    if seed is None:
+        spk_resamples = resample(np.arange(n_spk), nb_resamples)
+        blocks = [spk_resamples[start:start+block_size]
+                  for start in range(0, nb_resamples, block_size)]
+        spk_counts = [np.row_stack([np.bincount(spk_resample, minlength=n_spk)
+                                    for spk_resample in block])
+                      for block in blocks]
+        results = (bootstrap_spk_first(values, mask, key_contrasts, counts)[0]
+                   for counts in spk_counts)
+        pool = None
+    else:
+        replicates = np.arange(first_replicate, first_replicate+nb_resamples)
+        tasks = [(replicates[start:start+block_size], seed)
+                 for start in range(0, nb_resamples, block_size)]
+        if jobs > 1:
+            pool = multiprocessing.Pool(jobs,
+                                        initializer=set_bootstrap_statistics,
+                                        initargs=(statistics,))
+            # imap keeps the order of the replicates
+            results = pool.imap(bootstrap_task, tasks)
+        else:
+            set_bootstrap_statistics(statistics)
+            results = map(bootstrap_task, tasks)
+            pool = None
     mp_scores = []
-    for i, spk_resample in enumerate(spk_resamples):  # iterate on array rows
-        print(('Getting mp-scores for resample '
-               '{} over {}').format(i+1, nb_resamples))
-        resampled_data = []
-        for j, spk in enumerate(spk_resample):
-            spk_ix = spk_id.index(spk)
-            spk_df = spk_data[spk_ix].copy()
-            spk_df[speaker_col] = str(j)
-            resampled_data.append(spk_df)
-        resampled_data = pandas.concat(resampled_data)
-        resampled_data = drop_asymetric_scores(resampled_data, reg_cols)
-        mp_scores.append(minimal_pair_scores_spk_first(symetrize_scores(resampled_data,
-                                                                        reg_cols)))
+    for scores in results:
+        print(('Got mp-scores for {} resamples '
+               'over {}').format(len(mp_scores)+len(scores), nb_resamples))
+        for resample_scores in scores:
+            kept = ~np.isnan(resample_scores)
+            contrast_col = pandas.Categorical.from_codes(contrasts[kept],
+                                                         categories)
+            mp_scores.append(pandas.DataFrame({'contrast': contrast_col,
+                                               'score': resample_scores[kept]}))
+    if not(pool is None):
+        pool.close()
+        pool.join()
+    else:
+        set_bootstrap_statistics(None)
     return mp_scores
 
 
-
 #########################################
 # Loading resampled minimal-pair scores #
 #########################################
@@ -418,13 +1245,173 @@ def load_resampled_mp_errors(folder, get_metadata, bootid,
     return df, df_raws
 
 
+def scan_resampled_mp_files(folder, get_metadata, filt=None, files=None):
+    """
+    Scan a folder of resampled minimal-pair scores. Returns a dict giving
+    for each batch ('batch1', 'batch2', ...) a list of (filename, metadata)
+    pairs. files can be used to specify the names of the files to consider
+    instead of listing the folder (see load_mp_errors).
+    """
+    if filt is None:
+        filt = lambda x: True
+    if files is None:
+        files = os.listdir(folder)
+    batches = {}
+    for f in files:
+        model, ext = path.splitext(f)
+        if ext == '.pickle' and model + '.npz' in files:
+            continue
+        if ext in ['.pickle', '.npz'] and filt(model):
+            batch = model.split('__')[-1]
+            metadata = get_metadata(path.join(folder, f))
+            batches.setdefault(batch, []).append((f, metadata))
+    return batches
+
+
+def load_resampled_mp_error_batch(folder, batches, batchid, encoding=None,
+                                  nboot=1000, batchsize=50):
+    """
+    DataFrame containing all the resamples of batch batchid (among the
+    first nboot resamples) for all files in batches (as returned by
+    scan_resampled_mp_files), with a 'boot ID' column. Each resample has
+    the same rows as the DataFrame returned by load_resampled_mp_errors
+    for its boot ID.
+    """
+    first_bootid = (batchid-1)*batchsize
+    n = min(batchsize, nboot-first_bootid)
+    batch_files = batches.get('batch' + str(batchid), [])
+    assert batch_files, \
+        "No resampled mp scores found for batch {}".format(batchid)
+    dfs = []
+    boot_ids = []
+    for f, _ in batch_files:
+        fpath = path.join(folder, f)
+        if path.splitext(f)[1] == '.npz':
+            df_model = resample_store.stacked_resamples_df(
+                                    resample_store.load_resamples(fpath), n)
+            boot_ids.append(df_model['boot ID'].values + first_bootid)
+            dfs.append(df_model[['contrast', 'score']])
+        else:
+            with open(fpath, 'rb') as fh:
+                if encoding is None:
+                    df_raw = pickle.load(fh)
+                else:
+                    df_raw = pickle.load(fh, encoding=encoding)
+            dfs.extend([df_raw[i][['contrast', 'score']] for i in range(n)])
+            boot_ids.extend([np.full(len(df_raw[i]), first_bootid+i)
+                             for i in range(n)])
+    # each resample of a pickled batch gets the metadata of its file
+    metadata = [file_metadata for f, file_metadata in batch_files
+                for _ in range(1 if path.splitext(f)[1] == '.npz' else n)]
+    return concat_mp_errors(dfs, metadata, [('boot ID', boot_ids)])
+
+
+def nb_batches(nboot, batchsize):
+    return (nboot + batchsize - 1) // batchsize
+
+
+def load_resampled_mp_error_batches(folder, get_metadata,
+                                    filt=None, encoding=None,
+                                    nboot=1000, batchsize=50, files=None):
+    """
+    Iterate over batches of resampled minimal-pair errors from a folder
+    containing pickled (or .npz, see resample_store.py) versions of these,
+    yielding a DataFrame for each batch (see load_resampled_mp_error_batch).
+
+    The folder is scanned and the metadata of each file is obtained only
+    once, and each batch file is loaded only once.
+    """
+    batches = scan_resampled_mp_files(folder, get_metadata, filt=filt,
+                                      files=files)
+    for batchid in range(1, nb_batches(nboot, batchsize)+1):  # 1-indexed
+        yield load_resampled_mp_error_batch(folder, batches, batchid,
+                                            encoding=encoding, nboot=nboot,
+                                            batchsize=batchsize)
+
+
 ###########################################
 # Performing an analysis on all resamples #
 ###########################################
 
+def replicate_vectorized(analysis):
+    """
+    Decorator declaring that an analysis can be applied directly to several
+    resamples stacked together in a DataFrame with a 'boot ID' column,
+    returning the stacked results of applying it to each resample. This is
+    typically the case for analyses grouping rows by all columns but
+    'contrast' and 'error'.
+    resample_analysis then calls the analysis once for many resamples
+    instead of once per resample.
+    """
+    analysis.replicate_vectorized = True
+    return analysis
+
+
+def is_replicate_vectorized(analysis):
+    return getattr(analysis, 'replicate_vectorized', False)
+
+
+def resampled_columns(*cols):
+    """
+    Decorator declaring the columns of the results of an analysis whose
+    values vary across resamples (default: 'error'). Standard deviations
+    are estimated for the first one (see BootstrapAccumulator).
+    """
+    def decorator(analysis):
+        analysis.resampled_cols = list(cols)
+        return analysis
+    return decorator
+
+
+def analysis_resampled_cols(analysis):
+    return getattr(analysis, 'resampled_cols', None)
+
+
+# Process pools used to run analyses in parallel. Analyses, filters and
+# metadata functions are often lambdas or closures, which can't be pickled
+# to be sent to worker processes, so we rely on fork instead: the function
+# and its inputs are stored in a module-level variable before the pool is
+# created and are inherited by the workers, only task indices and results
+# are pickled.
+_fork_map_task = None
+
+
+def fork_map_call(i):
+    function, items = _fork_map_task
+    return function(items[i])
+
+
+def fork_map(function, items, n_jobs):
+    """
+    Same as list(map(function, items)), using a pool of n_jobs processes.
+    Results are returned in the order of items. Falls back to serial
+    execution if fork is not available (e.g. on Windows).
+    """
+    global _fork_map_task
+    if n_jobs > 1 and not('fork' in multiprocessing.get_all_start_methods()):
+        print("Process pools require fork, running serially instead")
+        n_jobs = 1
+    if n_jobs <= 1 or len(items) <= 1:
+        return [function(item) for item in items]
+    _fork_map_task = (function, items)
+    try:
+        pool = multiprocessing.get_context('fork').Pool(min(n_jobs,
+                                                            len(items)))
+        try:
+            results = pool.map(fork_map_call, range(len(items)))
+        finally:
+            pool.close()
+            pool.join()
+    finally:
+        _fork_map_task = None
+    return results
+
+
 def resample_analysis(analysis, resampled_mp_folder, get_metadata,
                       filt=None, encoding=None, add_metadata=None,
-                      nboot=1000, batchsize=50, verbose=0):
+                      nboot=1000, batchsize=50, verbose=0,
+                      accumulator=None, keep=True, boot_chunksize=None,
+                      n_jobs=1, files=None):
     """
     Carry out the same analysis on various resampled versions of minimal pair
     ABX scores.
@@ -436,65 +1423,180 @@ def resample_analysis(analysis, resampled_mp_folder, get_metadata,
            get_metadata : (str -> (name, value) list) function getting the
                            properties of each result file in
                            resampled_mp_folder from their file path
+           accumulator : BootstrapAccumulator, if specified each result
+                          is added to it
+           keep : bool, set to False to get an empty list instead of
+                  keeping all the results in memory (when accumulator is
+                  used)
+           boot_chunksize : int, for analyses declared replicate_vectorized,
+                  resamples are passed to the analysis one batch at a time
+                  by default. If specified, consecutive batches are passed
+                  together, by chunks of at least boot_chunksize resamples.
+           n_jobs : int, number of processes among which batches of
+                  resamples (grouped according to boot_chunksize) are
+                  distributed. Results are returned
+                  (and merged into accumulator) in batch order, so that they
+                  do not depend on the scheduling of the workers.
+           files : names of the files in resampled_mp_folder to consider
+                   (default: all files in the folder)
         Output:
-            resampled_res : list of elements from E of size nboot
+            resampled_res : list of elements from E of size nboot, or
+                            for analyses declared replicate_vectorized,
+                            list of DataFrames with a 'boot ID' column
+                            covering nboot resamples
             
     """
     resampled_res = []
-    for i in range(nboot):
-        if verbose > 1:
-            if i % (nboot//10) == 0:
-                print(("{}% of all bootstraps computed").format(100*i//nboot))
-        if i % batchsize == 0:   
-            df_raws = None
-        df, df_raws = load_resampled_mp_errors(resampled_mp_folder,
-                                               get_metadata,
-                                               i,
-                                               filt=filt,
-                                               encoding=encoding,
-                                               nboot=nboot,
-                                               batchsize=batchsize,
-                                               df_raws=df_raws)
-        if not(add_metadata is None):
-            df = add_metadata(df)
-        resampled_res.append(analysis(df))
+    if n_jobs > 1:
+        batches = scan_resampled_mp_files(resampled_mp_folder, get_metadata,
+                                          filt=filt, files=files)
+        def process_batches(batchids):
+            # each group of batches is processed with its own accumulator
+            # and results
+            batch_acc = None if accumulator is None else accumulator.empty_copy()
+            batch_dfs = (load_resampled_mp_error_batch(resampled_mp_folder,
+                                                       batches, batchid,
+                                                       encoding=encoding,
+                                                       nboot=nboot,
+                                                       batchsize=batchsize)
+                         for batchid in batchids)
+            batch_res = resample_analysis_batches(analysis, batch_dfs,
+                                                  add_metadata=add_metadata,
+                                                  accumulator=batch_acc,
+                                                  keep=keep,
+                                                  boot_chunksize=boot_chunksize)
+            if verbose > 1:
+                print(("Bootstraps of batches {} to {} computed"
+                       ).format(batchids[0], batchids[-1]))
+            return batch_res, batch_acc
+        # consecutive batches making up chunks of boot_chunksize resamples
+        # are processed together
+        if boot_chunksize is None:
+            group_size = 1
+        else:
+            group_size = max(1, -(-boot_chunksize // batchsize))
+        batchids = list(range(1, nb_batches(nboot, batchsize)+1))
+        groups = [batchids[start:start+group_size]
+                  for start in range(0, len(batchids), group_size)]
+        for batch_res, batch_acc in fork_map(process_batches, groups, n_jobs):
+            resampled_res = resampled_res + batch_res
+            if not(accumulator is None):
+                accumulator.merge(batch_acc)
+    else:
+        batches = load_resampled_mp_error_batches(resampled_mp_folder,
+                                                  get_metadata,
+                                                  filt=filt,
+                                                  encoding=encoding,
+                                                  nboot=nboot,
+                                                  batchsize=batchsize,
+                                                  files=files)
+        resampled_res = resample_analysis_batches(analysis, batches,
+                                                  add_metadata=add_metadata,
+                                                  accumulator=accumulator,
+                                                  keep=keep,
+                                                  boot_chunksize=boot_chunksize,
+                                                  nboot=nboot,
+                                                  verbose=verbose)
+    return resampled_res
+
+
+def resample_analysis_batches(analysis, batches, add_metadata=None,
+                              accumulator=None, keep=True,
+                              boot_chunksize=None, nboot=None, verbose=0):
+    """
+    Apply analysis to batches of resampled minimal-pair errors as yielded
+    by load_resampled_mp_error_batches (see resample_analysis)
+    """
+    resampled_res = []
+    def apply(df):
+        res = analysis(df)
+        if not(accumulator is None):
+            accumulator.add(res)
+        if keep:
+            resampled_res.append(res)
+    if is_replicate_vectorized(analysis):
+        # resamples are passed one batch at a time, or whole batches are
+        # regrouped into chunks of at least boot_chunksize resamples
+        pending, n_pending, n_done = [], 0, 0
+        for batch_df in batches:
+            if not(add_metadata is None):
+                batch_df = add_metadata(batch_df)
+            pending.append(batch_df)
+            n_pending = n_pending + batch_df['boot ID'].nunique()
+            if boot_chunksize is None or n_pending >= boot_chunksize:
+                apply(pandas.concat(pending, ignore_index=True))
+                n_done = n_done + n_pending
+                if verbose > 1:
+                    print("{} bootstraps computed".format(n_done))
+                pending, n_pending = [], 0
+        if pending:
+            apply(pandas.concat(pending, ignore_index=True))
+    else:
+        i = 0
+        for batch_df in batches:
+            # add_metadata is applied once to all resamples in the batch
+            if not(add_metadata is None):
+                batch_df = add_metadata(batch_df)
+            for _, df in batch_df.groupby('boot ID', sort=True):
+                if verbose > 1 and not(nboot is None):
+                    if i % max(nboot//10, 1) == 0:
+                        print(("{}% of all bootstraps computed").format(100*i//nboot))
+                apply(df)
+                i = i+1
     return resampled_res
 
 
 def resample_analysis_cached(resampling_file, analysis,
                              resampled_mp_folder=None, get_metadata=None,
                              filt=None, encoding=None, add_metadata=None,
-                             nboot=1000, batchsize=50, verbose=0):
+                             nboot=1000, batchsize=50, verbose=0,
+                             boot_chunksize=None, n_jobs=1, files=None):
     """
     Same as resample_analysis, but caching the results in intermediate files
     for quick re-use.
+
+    Results are cached in the folder of resampling_file, under a name
+    derived from the name of resampling_file and from a key identifying
+    the analysis, filt, get_metadata and add_metadata functions, the other
+    parameters and the input resample files, so that they are recomputed if
+    any of these changes (see analysis_cache.py).
     
+    files can be a list of file names (see resample_analysis) or a dict
+    mapping file names to their (size, mtime_ns), as returned by
+    catalog.select, in which case the input files are not accessed at all
+    when results are already cached.
+
     This assumes that the output of the analysis is pickable.
     """
-    if path.exists(resampling_file):
-        if verbose > 0:
-            print(("Using existing {} "
-                   "Delete this file if you want to recompute it"
-                   ).format(resampling_file))
-    else:
-        if verbose > 0:
-            print(("No {} file found, "
-                   "computing it"
-                   ).format(resampling_file))
-        assert not(resampled_mp_folder is None) and not(get_metadata is None)
-        resampled_res = resample_analysis(analysis, resampled_mp_folder, 
-                                          get_metadata, filt=filt,
-                                          encoding=encoding,
-                                          add_metadata=add_metadata,
-                                          nboot=nboot, batchsize=batchsize,
+    assert not(resampled_mp_folder is None) and not(get_metadata is None)
+    cache_dir, name = path.split(resampling_file)
+    name = path.splitext(name)[0]
+    key = analysis_cache.cache_key(analysis, filt, get_metadata,
+                                   add_metadata, encoding, nboot, batchsize,
+                                   analysis_cache.files_fingerprint(
+                                                    resampled_mp_folder, filt,
+                                                    files=files))
+    compute = lambda: resample_analysis(analysis, resampled_mp_folder,
+                                        get_metadata, filt=filt,
+                                        encoding=encoding,
+                                        add_metadata=add_metadata,
+                                        nboot=nboot, batchsize=batchsize,
+                                        verbose=verbose,
+                                        boot_chunksize=boot_chunksize,
+                                        n_jobs=n_jobs, files=files)
+    description = {'analysis': getattr(analysis, '__qualname__',
+                                       repr(analysis)),
+                   'nboot': nboot, 'batchsize': batchsize}
+    resampled_res = analysis_cache.cached(cache_dir, name, key, compute,
+                                          description=description,
                                           verbose=verbose)
-        with open(resampling_file, 'wb') as fh:
-            pickle.dump(resampled_res, fh)      
-    with open(resampling_file, 'rb') as fh:
-        resampled_res = pickle.load(fh)
     return resampled_res
 
 
+# columns identifying resamples in resampled analysis results
+BOOT_COLS = ["batch size", "batch ID", "boot ID"]
+
+
 def estimate_std(df, boot_df, resampled_cols=None):
     """
     Estimate standard deviations of some computed values from resamplings
@@ -503,14 +1605,181 @@ def estimate_std(df, boot_df, resampled_cols=None):
     """
     if resampled_cols is None:
         resampled_cols = ['error']
-    boot_cols = ["batch size", "batch ID", "boot ID"]
+    boot_cols = BOOT_COLS
     grouping_cols = set(boot_df.columns).difference(boot_cols+resampled_cols)
     grouping_cols = list(grouping_cols)
     # compute standard deviation estimates of resampled_cols
-    df_std = boot_df.groupby(grouping_cols, as_index=False).var()
+    # (boot_cols are categorical and cannot be aggregated)
+    df_std = boot_df[grouping_cols+resampled_cols].groupby(grouping_cols,
+                                                            as_index=False,
+                                                            observed=True).var()
     df_std["std"] = np.sqrt(df_std["error"])
-    for col in boot_cols+resampled_cols:
+    for col in resampled_cols:
         del df_std[col]
     df = pandas.merge(df, df_std, on=grouping_cols)
     return df
 
+
+class BootstrapAccumulator(object):
+    """
+    Same as estimate_std, but updating running statistics as each resampled
+    analysis result arrives, so that all resamples never need to be
+    concatenated together.
+
+    For each group of rows (defined as in estimate_std), the count, mean and
+    sum of squared deviations of errors (or of the first of resampled_cols)
+    are merged with those of each new
+    resample (Chan et al.'s parallel variant of Welford's algorithm).
+    If ci is specified (e.g. 95), errors are also kept in compact buffers
+    (one integer group id and one float per row) to get exact percentile
+    confidence intervals. Their size grows with the number of resamples
+    (O(resamples x rows)), unlike that of the other statistics.
+
+    Usage:
+        acc = BootstrapAccumulator()
+        for boot_df in resampled_analysis_results:
+            acc.add(boot_df)
+        df = acc.add_std(df)
+    """
+
+    def __init__(self, resampled_cols=None, ci=None):
+        if resampled_cols is None:
+            resampled_cols = ['error']
+        self.resampled_cols = resampled_cols
+        self.ci = ci
+        self.grouping_cols = None
+        self.keys = None  # groups seen so far
+        self.n = np.zeros(0)
+        self.mean = np.zeros(0)
+        self.m2 = np.zeros(0)
+        self.ids = []
+        self.values = []
+
+    def group_ids(self, index):
+        # global ids of the groups in index, new groups get new ids
+        if not(isinstance(index, pandas.MultiIndex)):
+            index = pandas.MultiIndex.from_arrays([index])
+        if self.keys is None:
+            self.keys = index
+            ids = np.arange(len(index))
+        else:
+            ids = self.keys.get_indexer(index)
+            new = ids == -1
+            ids[new] = np.arange(len(self.keys), len(self.keys)+new.sum())
+            self.keys = self.keys.append(index[new])
+        n_new = len(self.keys) - len(self.n)
+        self.n = np.concatenate([self.n, np.zeros(n_new)])
+        self.mean = np.concatenate([self.mean, np.zeros(n_new)])
+        self.m2 = np.concatenate([self.m2, np.zeros(n_new)])
+        return ids
+
+    def add(self, boot_df):
+        """Update statistics with one (or several) resampled results"""
+        if self.grouping_cols is None:
+            cols = set(boot_df.columns).difference(BOOT_COLS +
+                                                   self.resampled_cols)
+            self.grouping_cols = sorted(cols)
+        errors = boot_df[self.resampled_cols[0]].astype(np.float64)
+        groups = errors.groupby([boot_df[col] for col in self.grouping_cols],
+                                observed=True)
+        n = groups.count()
+        ids = self.group_ids(n.index)
+        n = n.values
+        mean = groups.mean().fillna(0).values
+        m2 = (groups.var(ddof=0)*n).fillna(0).values
+        self.merge_stats(ids, n, mean, m2)
+        if not(self.ci is None):
+            row_groups = groups.ngroup().values
+            kept = row_groups >= 0  # rows with missing keys are not grouped
+            self.ids.append(ids[row_groups[kept]].astype(np.int32))
+            self.values.append(errors.values[kept])
+
+    def merge_stats(self, ids, n, mean, m2):
+        # merge statistics for groups ids with the current ones
+        n_a, mean_a, m2_a = self.n[ids], self.mean[ids], self.m2[ids]
+        n_ab = n_a + n
+        with np.errstate(invalid='ignore', divide='ignore'):
+            delta = mean - mean_a
+            self.mean[ids] = np.where(n_ab > 0, mean_a + delta*n/n_ab, 0)
+            self.m2[ids] = np.where(n_ab > 0,
+                                    m2_a + m2 + delta**2*n_a*n/n_ab, 0)
+        self.n[ids] = n_ab
+
+    def merge(self, other):
+        """
+        Update statistics with those of another accumulator (e.g. one filled
+        in another process)
+        """
+        if other.keys is None:
+            return
+        if self.grouping_cols is None:
+            self.grouping_cols = other.grouping_cols
+        ids = self.group_ids(other.keys)
+        self.merge_stats(ids, other.n, other.mean, other.m2)
+        self.ids.extend([ids[e].astype(np.int32) for e in other.ids])
+        self.values.extend(other.values)
+
+    def empty_copy(self):
+        return BootstrapAccumulator(resampled_cols=self.resampled_cols,
+                                    ci=self.ci)
+
+    def result(self):
+        """
+        DataFrame with grouping columns, standard deviation estimates
+        ('std') and, if ci was specified, confidence intervals
+        ('ci low' and 'ci high').
+        """
+        res = self.keys.to_frame(index=False)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            var = np.where(self.n > 1, self.m2 / (self.n-1), np.nan)
+        res['std'] = np.sqrt(var)
+        if not(self.ci is None):
+            low = (100-self.ci) / 200.
+            values = pandas.Series(np.concatenate(self.values))
+            quantiles = values.groupby(np.concatenate(self.ids)).quantile(
+                                                            [low, 1-low])
+            # (groups and quantiles are missing for empty results)
+            quantiles = quantiles.unstack().reindex(index=np.arange(len(res)),
+                                                    columns=[low, 1-low])
+            res['ci low'] = quantiles[low].values
+            res['ci high'] = quantiles[1-low].values
+        return res
+
+    def add_std(self, df):
+        """Add estimates to the (non-resampled) analysis results df"""
+        return pandas.merge(df, self.result(), on=self.grouping_cols)
+
+
+
+class BootstrapAccumulators(object):
+    """
+    BootstrapAccumulator for analyses returning a dict of results (e.g. a
+    dict of named analyses applied together, see apply_analyses.py): each
+    entry of the results gets its own accumulator.
+
+    Usage:
+        acc = BootstrapAccumulators({name: BootstrapAccumulator(), ...})
+        for boot_res in resampled_analysis_results:
+            acc.add(boot_res)
+        res = acc.add_std(res)
+    """
+
+    def __init__(self, accumulators):
+        self.accumulators = accumulators
+
+    def add(self, boot_res):
+        for name, accumulator in self.accumulators.items():
+            accumulator.add(boot_res[name])
+
+    def merge(self, other):
+        for name, accumulator in self.accumulators.items():
+            accumulator.merge(other.accumulators[name])
+
+    def empty_copy(self):
+        return BootstrapAccumulators({name: accumulator.empty_copy()
+                                      for name, accumulator
+                                      in self.accumulators.items()})
+
+    def add_std(self, res):
+        return {name: self.accumulators[name].add_std(res[name])
+                for name in res}
@@ -11,11 +11,18 @@ Usage example:
    cd path/2/ABX/results/folder/
    mkdir minimal_pair
    python precompute_mp_scores.py ./ minimal_pair
+
+Several types of mp-scores can be computed at once, in which case
+they are stored in separate subfolders of the output folder:
+   python precompute_mp_scores.py ./ minimal_pair --mp_type spk_first --mp_type by_spk
 """
 
 import argparse
 import os.path as path
 import scone_phobia.utils.mp_scores as mp_scores
+import scone_phobia.utils.results_cache as results_cache
+import scone_phobia.utils.catalog as catalog
+import scone_phobia.utils.apply_analyses as apply_analyses
 
 
 if __name__ == '__main__':
@@ -23,23 +30,52 @@ if __name__ == '__main__':
     parser.add_argument('in_dir', help="ABX results files folder")
     parser.add_argument('out_dir', help="Folder where to store mp scores") 
     parser.add_argument('--overwrite', action='store_true',
-                        help=("use this if you want to overwrite existing"
-                              " pickles in out_dir"))
-    parser.add_argument('--mp_type', default='spk_first',
-                        help="Type of minimal-pair scores to compute")               
+                        help=("use this if you want to recompute all"
+                              " pickles in out_dir, even up-to-date ones"))
+    parser.add_argument('--mp_type', action='append',
+                        choices=mp_scores.MP_TYPES,
+                        help=("Type of minimal-pair scores to compute"
+                              " (default: spk_first). Can be repeated to"
+                              " compute several types at once."))
+    parser.add_argument('--chunksize', type=int, default=None,
+                        help=("read ABX results files by chunks of that many"
+                              " lines, for files that do not fit in memory"))
+    parser.add_argument('--cache_dir', default=None,
+                        help=("folder where parsed results files are cached"
+                              " (default: .scone_phobia_cache folder in"
+                              " in_dir)"))
+    parser.add_argument('--no_cache', action='store_true',
+                        help="parse results files without using the cache")
+    parser.add_argument('--jobs', type=int, default=1,
+                        help="number of results files to process in parallel")
+    parser.add_argument('--spk_shards', type=int, default=None,
+                        help=("split each results file by speakers into that"
+                              " many shards symetrized in parallel (useful"
+                              " when one big file dominates the runtime)"))
     args = parser.parse_args()
     assert path.exists(args.in_dir), \
         "Input folder {} missing".format(args.in_dir)
     assert path.exists(args.out_dir), \
         "Output folder {} missing".format(args.out_dir)
+    mp_types = ['spk_first'] if args.mp_type is None else args.mp_type
     if args.overwrite:
-        filt = None
         print(("precompute_mp_scores.py: overwriting any pre-existing" 
                " pickle in {}".format(args.out_dir)))
     else:
-        filt = lambda x: not(path.exists(path.join(args.out_dir, x+'.pickle')))
-        print(("precompute_mp_scores.py: mp scores in pre-existing pickles"
-               " in {} will not be computed again, use the --overwrite"
-               " switch if you want to force them to be computed again."
-               ).format(args.out_dir))
-    mp_scores.precompute_mp_scores(args.in_dir, args.out_dir, filt=filt, mp_type=args.mp_type) 
\ No newline at end of file
+        print(("precompute_mp_scores.py: up-to-date mp scores in {} (as"
+               " recorded in {}) will not be computed again, use the"
+               " --overwrite switch if you want to force them to be computed"
+               " again.").format(args.out_dir, mp_scores.MANIFEST_FILE))
+    if args.no_cache:
+        cache_dir = None
+    elif args.cache_dir is None:
+        cache_dir = results_cache.default_cache_dir(args.in_dir)
+    else:
+        cache_dir = args.cache_dir
+    mp_scores.precompute_mp_scores(args.in_dir, args.out_dir, mp_type=mp_types,
+                                   chunksize=args.chunksize, cache_dir=cache_dir,
+                                   overwrite=args.overwrite, jobs=args.jobs,
+                                   spk_shards=args.spk_shards)
+    # keep the catalogs used by apply_analysis up-to-date (see catalog.py)
+    for folder in mp_scores.mp_type_folders(args.out_dir, mp_types).values():
+        catalog.update(folder, apply_analyses.parse_res_fname, verbose=1)
\ No newline at end of file
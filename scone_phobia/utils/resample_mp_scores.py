@@ -10,21 +10,41 @@ ABX minimal-pair scores in a reasonable amount of time.
 Usage: 
     python resample_mp_scores.py root model_type n_boot batch_id
 
-batch_id is used both as a unique id for the output file and as a seed for 
-random number generation.
+batch_id is used both as a unique id for the output file and to determine
+which replicates are computed: batch batch_id (starting from 1) contains
+replicates (batch_id-1)*n_boot to batch_id*n_boot-1. Each replicate is
+drawn from its own random stream derived from the --seed option and from
+its index, so that a replicate does not depend on how the computation is
+split into batches, jobs or processes (--jobs).
+
+Resamples are stored in a .npz file (see resample_store.py) and the
+catalog of the output folder used by apply_analysis is updated (see
+catalog.py).
+
+The parsed and symetrized results file is cached (by default in a
+'.scone_phobia_cache' folder next to the results file, see results_cache.py),
+so that only the first of several jobs resampling the same results file
+has to parse it.
 """
 
 import scone_phobia.utils.mp_scores as mp_scores
-import pickle
+import scone_phobia.utils.results_cache as results_cache
+import scone_phobia.utils.resample_store as resample_store
+import scone_phobia.utils.catalog as catalog
+import scone_phobia.utils.apply_analyses as apply_analyses
 import os.path as path
-import numpy as np
 
 
-def resample_mp_scores(result_file, reg_cols, n_boot, batch_id):
-    np.random.seed(batch_id)
-    raw_res = mp_scores.load_df(result_file, reg_cols)
-    mp_boot = mp_scores.resample_mp_score_within_speakers(raw_res, n_boot,
-                                                          reg_cols)
+def resample_mp_scores(result_file, reg_cols, n_boot, batch_id, seed=0,
+                       jobs=1, cache_dir=None):
+    assert batch_id >= 1, "batch_id should start from 1"
+    sym_res = mp_scores.symetrized_scores(result_file, reg_cols,
+                                          cache_dir=cache_dir)
+    mp_boot = mp_scores.resample_mp_score_within_speakers(
+                                        sym_res, n_boot, reg_cols,
+                                        symetrized=True, seed=seed,
+                                        first_replicate=(batch_id-1)*n_boot,
+                                        jobs=jobs)
     return mp_boot
 
 
@@ -40,20 +60,46 @@ if __name__ == '__main__':
                         help="number of boostrap resampling to be computed")
     parser.add_argument('batch_id', type=int,
                         help="unique identifier for the result file")
+    parser.add_argument('--cache_dir', default=None,
+                        help=("folder where parsed results files are cached"
+                              " (default: .scone_phobia_cache folder next to"
+                              " result_file)"))
+    parser.add_argument('--no_cache', action='store_true',
+                        help="parse result_file without using the cache")
+    parser.add_argument('--seed', type=int, default=0,
+                        help=("root random seed, should be the same for all"
+                              " batches (default: 0)"))
+    parser.add_argument('--jobs', type=int, default=1,
+                        help="number of processes computing replicates")
+    parser.add_argument('--uncompressed', action='store_true',
+                        help=("store resamples uncompressed, so that they"
+                              " can be memory-mapped when loaded"))
     args = parser.parse_args()
 
     # hard-coded for now:
     reg_cols = ['talker', 'prev-phone', 'next-phone']
     fid = path.splitext(path.basename(args.result_file))[0]
-    fname = fid + '__batchsize{}__batch{}.pickle'.format(args.n_boot,
+    fname = fid + '__batchsize{}__batch{}.npz'.format(args.n_boot,
                                                        args.batch_id)
     res_path = path.join(args.output_folder, fname)
     assert path.exists(args.result_file), args.result_file
     assert path.exists(args.output_folder), args.output_folder
     assert not(path.exists(res_path)), res_path
 
+    if args.no_cache:
+        cache_dir = None
+    elif args.cache_dir is None:
+        cache_dir = results_cache.default_cache_dir(
+                                            path.dirname(args.result_file))
+    else:
+        cache_dir = args.cache_dir
     mp_boot = resample_mp_scores(args.result_file, reg_cols,
-                                 args.n_boot, args.batch_id)
+                                 args.n_boot, args.batch_id,
+                                 seed=args.seed, jobs=args.jobs,
+                                 cache_dir=cache_dir)
 
-    with open(res_path, 'wb') as fh:
-        pickle.dump(mp_boot, fh)
\ No newline at end of file
+    resample_store.save_resamples(mp_boot, res_path,
+                                  compressed=not(args.uncompressed))
+    # keep the catalog used by apply_analysis up-to-date (see catalog.py)
+    catalog.update(args.output_folder, apply_analyses.parse_bootres_fname,
+                   verbose=1)
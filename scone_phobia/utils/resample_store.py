@@ -0,0 +1,181 @@
+# -*- coding: utf-8 -*-
+"""
+Array-backed storage for bootstrap resamples of minimal-pair scores.
+
+A batch of resamples, as returned by
+mp_scores.resample_mp_score_within_speakers, is a list of (contrast, score)
+DataFrames which all share (nearly) the same contrasts. Instead of pickling
+the list, we store the sorted contrasts once together with a
+(resamples, contrasts) float32 array of scores and a boolean array of the
+same shape indicating which contrasts are present in each resample (so that
+NaN scores are kept as such) in a .npz file. Files without the latter,
+written by earlier versions, use NaN for missing contrasts.
+
+By default the .npz file is compressed. If it is stored uncompressed,
+the arrays are memory-mapped when loaded, so that only the
+resamples actually used are read from disk.
+
+Pickled batches produced by earlier versions of resample_mp_scores.py can
+be converted with:
+    python resample_store.py migrate path/2/mpscores/resampling
+"""
+
+import argparse
+import os
+import os.path as path
+import pickle
+import zipfile
+import numpy as np
+import pandas
+import scone_phobia.utils.results_cache as results_cache
+
+
+def batch_arrays(mp_boot):
+    """
+    Sorted contrasts, (resamples, contrasts) scores and presence mask of a
+    batch
+    """
+    contrasts = np.unique(np.concatenate([np.asarray(df['contrast'],
+                                                     dtype=object).astype(str)
+                                          for df in mp_boot]))
+    scores = np.full((len(mp_boot), len(contrasts)), np.nan, dtype=np.float32)
+    present = np.zeros(scores.shape, dtype=bool)
+    for i, df in enumerate(mp_boot):
+        ix = np.searchsorted(contrasts,
+                             np.asarray(df['contrast'], dtype=object).astype(str))
+        scores[i, ix] = df['score'].values
+        present[i, ix] = True
+    return contrasts, scores, present
+
+
+def save_resamples(mp_boot, fname, compressed=True):
+    contrasts, scores, present = batch_arrays(mp_boot)
+    savez = np.savez_compressed if compressed else np.savez
+    results_cache.atomic_save(fname, lambda fh: savez(fh, contrasts=contrasts,
+                                                      scores=scores,
+                                                      present=present))
+
+
+def memmap_npz_member(fname, name):
+    """
+    Memory-map array name from an uncompressed .npz file,
+    or return None if it is compressed.
+    """
+    with zipfile.ZipFile(fname) as zf:
+        info = zf.getinfo(name + '.npy')
+    if info.compress_type != zipfile.ZIP_STORED:
+        return None
+    with open(fname, 'rb') as fh:
+        # skip the local file header of the zip member
+        fh.seek(info.header_offset)
+        header = fh.read(30)
+        name_len = int.from_bytes(header[26:28], 'little')
+        extra_len = int.from_bytes(header[28:30], 'little')
+        fh.seek(info.header_offset + 30 + name_len + extra_len)
+        # then the header of the .npy file
+        version = np.lib.format.read_magic(fh)
+        if version == (1, 0):
+            shape, fortran, dtype = np.lib.format.read_array_header_1_0(fh)
+        else:
+            shape, fortran, dtype = np.lib.format.read_array_header_2_0(fh)
+        offset = fh.tell()
+    order = 'F' if fortran else 'C'
+    return np.memmap(fname, dtype=dtype, mode='r', offset=offset,
+                     shape=shape, order=order)
+
+
+def load_resamples(fname):
+    """
+    Sorted contrasts, (resamples, contrasts) scores and presence mask of a
+    batch, the arrays being memory-mapped if the file is not compressed.
+    """
+    with np.load(fname) as data:
+        contrasts = data['contrasts'].astype(object)
+        scores = memmap_npz_member(fname, 'scores')
+        if scores is None:
+            scores = data['scores']
+        if 'present' in data.files:
+            present = memmap_npz_member(fname, 'present')
+            if present is None:
+                present = data['present']
+        else:
+            present = None
+    return contrasts, scores, present
+
+
+def presence(scores, present):
+    # presence mask of scores, NaN meaning missing for files without one
+    if present is None:
+        return ~np.isnan(scores)
+    return np.asarray(present)
+
+
+def resample_df(batch, i):
+    """
+    (contrast, score) DataFrame for resample i of a batch as returned by
+    load_resamples, in the same format as the DataFrames in the pickled
+    batches.
+    """
+    contrasts, scores, present = batch
+    resample_scores = np.asarray(scores[i])
+    kept = presence(resample_scores, None if present is None else present[i])
+    contrast_col = pandas.Categorical.from_codes(
+                                np.arange(len(contrasts))[kept], contrasts)
+    return pandas.DataFrame({'contrast': contrast_col,
+                             'score': resample_scores[kept]})
+
+
+def stacked_resamples_df(batch, n):
+    """
+    (contrast, score, 'boot ID') DataFrame for the first n resamples of a
+    batch as returned by load_resamples, with rows for successive resamples
+    stacked together and 'boot ID' giving the index of the resample in the
+    batch.
+    """
+    contrasts, scores, present = batch
+    scores = np.asarray(scores[:n])
+    kept = presence(scores, None if present is None else present[:n])
+    contrast_codes = np.broadcast_to(np.arange(len(contrasts)), scores.shape)
+    boot_ids = np.broadcast_to(np.arange(n)[:, None], scores.shape)
+    contrast_col = pandas.Categorical.from_codes(contrast_codes[kept],
+                                                 contrasts)
+    return pandas.DataFrame({'contrast': contrast_col,
+                             'score': scores[kept],
+                             'boot ID': boot_ids[kept]})
+
+
+def migrate(folder, compressed=True, encoding='latin1', delete=False):
+    """
+    Convert pickled batches of resamples in folder to .npz files with the
+    same name. Pickles are left in place unless delete is True (.npz batches
+    are preferred when both are present).
+    """
+    for f in sorted(os.listdir(folder)):
+        name, ext = path.splitext(f)
+        npz_file = path.join(folder, name + '.npz')
+        if ext == '.pickle' and not(path.exists(npz_file)):
+            with open(path.join(folder, f), 'rb') as fh:
+                mp_boot = pickle.load(fh, encoding=encoding)
+            save_resamples(mp_boot, npz_file, compressed=compressed)
+            print("Converted {}".format(f))
+        if ext == '.pickle' and delete and path.exists(npz_file):
+            os.remove(path.join(folder, f))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('command', choices=['migrate'],
+                        help="only 'migrate' is currently supported")
+    parser.add_argument('folder',
+                        help="folder containing pickled batches of resamples")
+    parser.add_argument('--uncompressed', action='store_true',
+                        help=("store uncompressed .npz files, which can be"
+                              " memory-mapped"))
+    parser.add_argument('--encoding', default='latin1',
+                        help="encoding to use to load the pickles")
+    parser.add_argument('--delete', action='store_true',
+                        help="delete pickles once they have been converted")
+    args = parser.parse_args()
+    if args.command == 'migrate':
+        migrate(args.folder, compressed=not(args.uncompressed),
+                encoding=args.encoding, delete=args.delete)
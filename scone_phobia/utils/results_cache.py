@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+"""
+On-disk cache of parsed ABXpy results.
+
+Parsing an ABXpy results file and symetrizing its scores takes a while and
+the same file is typically processed many times (once by
+precompute_mp_scores.py and once per resampling job). This module
+stores the resulting pandas.DataFrame in a binary columnar format (one
+numpy array per column in an uncompressed .npz file) which is much faster
+to load than the original text file.
+
+Cache entries are keyed by a fingerprint of the content of the original
+results file (and of the parameters used to parse it), so that they are
+automatically ignored if the results file is regenerated. Stale entries are
+not deleted automatically, delete the cache folder to reclaim disk space.
+"""
+
+import hashlib
+import os
+import os.path as path
+import tempfile
+import numpy as np
+import pandas
+
+
+# increment this if the content or format of cache entries changes
+CACHE_VERSION = 2
+
+
+def file_fingerprint(fname, blocksize=2**20):
+    """SHA-1 hex digest of the content of a file"""
+    h = hashlib.sha1()
+    with open(fname, 'rb') as fh:
+        block = fh.read(blocksize)
+        while block:
+            h.update(block)
+            block = fh.read(blocksize)
+    return h.hexdigest()
+
+
+def cache_key(fingerprint, *params):
+    """Combine a file fingerprint with the parameters used to process it"""
+    h = hashlib.sha1()
+    h.update(repr((CACHE_VERSION, fingerprint, params)).encode('utf-8'))
+    return h.hexdigest()
+
+
+def default_cache_dir(results_folder):
+    # cache folder shared by all results files in the same folder
+    return path.join(results_folder, '.scone_phobia_cache')
+
+
+def cache_file(cache_dir, key):
+    return path.join(cache_dir, key + '.npz')
+
+
+def atomic_save(fname, save):
+    """
+    Call save on a temporary file in the same folder as fname and
+    then move it to fname, so that partially written files never
+    appear under the name fname (for example if several jobs try to
+    write the same file concurrently).
+    """
+    fd, tmp = tempfile.mkstemp(dir=path.dirname(path.abspath(fname)),
+                               suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as fh:
+            save(fh)
+        # mkstemp creates files readable by their owner only, use the
+        # same permissions as for a file created with open instead
+        umask = os.umask(0)
+        os.umask(umask)
+        os.chmod(tmp, 0o666 & ~umask)
+        os.replace(tmp, fname)
+    except BaseException:
+        os.remove(tmp)
+        raise
+
+
+def save_df(df, fname):
+    """
+    Store the columns of df as arrays in a .npz file.
+    Categorical columns are stored as codes plus categories.
+    """
+    arrays = {'__columns__': np.array(list(df.columns), dtype=str)}
+    for i, col in enumerate(df.columns):
+        name = 'col{}'.format(i)
+        if isinstance(df[col].dtype, pandas.api.types.CategoricalDtype):
+            arrays[name] = df[col].cat.codes.values
+            categories = np.asarray(df[col].cat.categories)
+            arrays[name + '_categories'] = categories.astype(str)
+        else:
+            arr = df[col].values
+            if arr.dtype == object:
+                arr = arr.astype(str)
+            arrays[name] = arr
+    atomic_save(fname, lambda fh: np.savez(fh, **arrays))
+
+
+def load_df(fname):
+    with np.load(fname) as data:
+        cols = list(data['__columns__'])
+        columns = {}
+        for i, col in enumerate(cols):
+            name = 'col{}'.format(i)
+            if name + '_categories' in data:
+                categories = data[name + '_categories'].astype(object)
+                columns[col] = pandas.Categorical.from_codes(data[name],
+                                                             categories)
+            else:
+                # unicode arrays are converted to object columns by pandas,
+                # as in dataframes obtained directly from the results files
+                columns[col] = data[name]
+        df = pandas.DataFrame(columns, columns=cols)
+    return df
+
+
+def cached(cache_dir, key, compute, verbose=True):
+    """
+    Return the DataFrame stored in cache_dir under key if it exists,
+    otherwise compute it with compute() and store it there.
+    """
+    fname = cache_file(cache_dir, key)
+    if path.exists(fname):
+        if verbose:
+            print("Using cached parsed results {}".format(fname))
+        df = load_df(fname)
+    else:
+        df = compute()
+        if not(path.exists(cache_dir)):
+            os.makedirs(cache_dir, exist_ok=True)
+        save_df(df, fname)
+    return df